@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 import asyncio
-from datetime import datetime, timedelta, timezone, time
-from collections import defaultdict
-from typing import Dict, Set, List, Tuple
+import sys
+from datetime import datetime, timedelta, timezone, time, date
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python 3.8
+    from backports.zoneinfo import ZoneInfo
+from collections import defaultdict, OrderedDict, deque
+from typing import Dict, Set, List, Tuple, Iterable, Optional, Callable, Awaitable
 import random
+import heapq
 import hashlib
 import base64
+import os
+import json
+import mmap
+import struct
+import sqlite3
+import threading
+import zlib
+import re
+from array import array
+from functools import partial, wraps
+from itertools import compress, repeat
+from operator import attrgetter
+from time import perf_counter, monotonic
 
 from telegram import (
     Update,
@@ -22,6 +41,8 @@ from telegram.ext import (
     MessageHandler,
     ChatMemberHandler,
     MessageReactionHandler,
+    TypeHandler,
+    BaseUpdateProcessor,
     filters,
     ContextTypes,
 )
@@ -39,16 +60,76 @@ NEW_MEMBER_WARN_BEFORE = timedelta(minutes=15)
 INACTIVITY_WARN_AT = timedelta(hours=48)
 INACTIVITY_KICK_AT = timedelta(hours=72)
 CHECK_INTERVAL = timedelta(minutes=15)
+DEADLINE_TICK = timedelta(minutes=1)  # Warnings/kicks fire within this of their deadline
+ADMIN_RECHECK = timedelta(hours=24)  # Admins are exempt; look again this much later
+JOB_CHAT_CONCURRENCY = 20  # Chats worked on at once across all periodic jobs
+JOB_CHAT_TIMEOUT = timedelta(seconds=30)  # Per-chat budget within one job tick
 
-# Daily top-poster window
+# Rolling activity windows (/stats rolling, /leaderboard rolling)
 DAILY_WINDOW = timedelta(hours=24)
 WEEKLY_WINDOW = timedelta(days=7)
+ROLLING_BUCKET = timedelta(hours=1)  # Resolution: counts move out of a window one bucket at a time
+
+# Persistence
+STORAGE_BACKEND = "sqlite"  # "sqlite" (durable, WAL), "eventlog" (snapshot + event log) or "memory"
+STORAGE_PATH = "bot_state.db"
+EVENT_LOG_DIR = "events"
+EVENT_LOG_SEGMENT_BYTES = 64 * 1024 * 1024  # Rotate segments at this size
+EVENT_LOG_ARCHIVE = True  # Keep compacted segments under EVENT_LOG_DIR/archive for full replays
+PERSIST_FLUSH_INTERVAL = timedelta(milliseconds=1000)  # Write-behind flush period
+PERSIST_FLUSH_MAX_UPDATES = 500  # ...or flush early after this many updates
+PERSIST_DRAIN_BATCH = 500  # Rows serialized per event-loop turn during a flush
+SNAPSHOT_PATH = "bot_state.snap"  # Binary snapshot for fast restarts ("" disables)
+SNAPSHOT_INTERVAL = timedelta(minutes=10)
+
+# Message author index (used to credit reactions)
+MESSAGE_AUTHOR_HORIZON = 20000  # Remember authors of the last N messages per chat
+MESSAGE_AUTHOR_MAX_AGE = timedelta(days=7)  # ...that are at most this old (None = no age limit)
+MOST_LOVED_TOP_K = 10  # Posts kept per chat for /loved
+
+# Display-name cache for mentions
+NAME_CACHE_TTL = timedelta(hours=6)
+NAME_CACHE_NEGATIVE_TTL = timedelta(minutes=10)  # Remember failed lookups this long
+NAME_CACHE_MAX_ENTRIES = 50000
+NAME_RESOLVE_CONCURRENCY = 10  # Parallel get_chat_member calls per report
+NAME_RESOLVE_DEADLINE = timedelta(seconds=3)  # Unresolved names fall back to "User"
+ADMIN_ROSTER_TTL = timedelta(hours=1)  # Re-fetch a chat's admins this often (member updates apply at once)
+
+# Updates from different chats/users are processed concurrently, up to this
+# many at once; updates from the same (chat, user) are still handled in order
+UPDATE_CONCURRENCY = 64
+
+# Outbound rate limits (Telegram: ~30 msg/s overall, ~20 msg/min per group)
+OUTBOUND_GLOBAL_RATE = 30  # messages per second
+OUTBOUND_CHAT_RATE = 20  # messages per minute per chat
+OUTBOUND_CHAT_BURST = 5  # messages a quiet chat may receive back-to-back
+OUTBOUND_QUEUE_MAX = 1000  # Senders wait (backpressure) while this many are queued
+OUTBOUND_MAX_ATTEMPTS = 5
+
+# Announcements (level-ups, achievements, badges, warnings...) for a chat are
+# merged into one message per window
+ANNOUNCE_BATCH_WINDOW = timedelta(seconds=1.5)
+ANNOUNCE_MAX_CHARS = 4000  # Telegram caps messages at 4096 characters
+ANNOUNCE_DEDUP_TTL = timedelta(minutes=10)  # Drop identical announcements repeated within this time
+
+# Durable outbox: announcements survive failures and restarts until delivered
+OUTBOX_PATH = "bot_outbox.db"  # SQLite file ("" keeps the outbox in memory)
+OUTBOX_MAX_ATTEMPTS = 5  # Delivery rounds (each with the scheduler's own retries) before dead-lettering
+OUTBOX_RETRY_INTERVAL = timedelta(seconds=30)  # Base backoff between rounds
+OUTBOX_RETENTION = timedelta(days=7)  # Keep delivered keys this long to block re-posts
 
 # Streak & Badge thresholds
 DAILY_STREAK_THRESHOLD = 1  # posts per day
 WEEKLY_STREAK_THRESHOLD = 5  # posts per week
 STREAK_CHECK_INTERVAL = timedelta(hours=6)  # Check streaks every 6 hours
 
+# Weekly reset on a wall-clock boundary: every WEEKLY_RESET_WEEKDAY (0 = Monday)
+# at WEEKLY_RESET_TIME in WEEKLY_RESET_TZ. A boundary missed while the bot was
+# down is caught up once on startup.
+WEEKLY_RESET_WEEKDAY = 0
+WEEKLY_RESET_TIME = time(0, 0)
+WEEKLY_RESET_TZ = "UTC"
+
 # Points for content
 PTS_PHOTO = 1
 PTS_VIDEO = 1
@@ -237,14 +318,15 @@ HELP_TEXT = (
     "🤖 <b>Strictly🇬🇧Bot Commands</b>\n\n"
     "📌 /rules → Show group rules\n"
     "🆔 /chatid → Display this group's Chat ID\n"
-    "📊 /stats → Show daily stats & top posters\n"
+    "📊 /stats → Show daily stats & top posters (/stats rolling: last 24h)\n"
     "🏅 /achievements → Show your unlocked badges\n"
     "🏆 /top → Show today's top posters\n"
     "⭐ /level → Show your XP & Level\n"
     "🔥 /streak → Show your posting streak\n"
     "🎖️ /badges → Show available badges to unlock\n"
-    "📈 /leaderboard → Show weekly leaderboard\n"
+    "📈 /leaderboard → Show weekly leaderboard (/leaderboard rolling: last 7 days)\n"
     "❤️ /reactions → Show weekly reaction reports\n"
+    "💖 /loved → Show this week's most loved posts\n"
     "👤 /profile → Show complete user profile\n"
     "🏅 /ranking → Show all-time rankings\n"
     "💰 /coins → Show your coin balance\n"
@@ -265,12 +347,517 @@ HELP_TEXT = (
 
 UTC = timezone.utc
 
+# ========= MESSAGE INDEX =========
+class MessageAuthorIndex:
+    """Fixed-horizon message_id -> author map for one chat.
+
+    Telegram message ids grow monotonically per chat, so each id owns the
+    slot message_id % capacity of an array-backed ring. A newer message
+    overwrites the slot of one at least `capacity` messages older, which is
+    the eviction. The ring starts small and doubles up to the horizon. A
+    slot never goes back to an older id, so re-adding an edited message
+    cannot evict a newer one.
+    """
+    __slots__ = ("capacity", "horizon", "ids", "authors", "stamps", "size")
+
+    def __init__(self, horizon: int = MESSAGE_AUTHOR_HORIZON, capacity: int = 64):
+        self.horizon = horizon
+        self.capacity = min(capacity, horizon)
+        self.ids = array("q", bytes(8 * self.capacity))
+        self.authors = array("q", bytes(8 * self.capacity))
+        self.stamps = array("I", bytes(4 * self.capacity))
+        self.size = 0
+
+    def add(self, message_id: int, author_id: int, when: datetime):
+        slot = message_id % self.capacity
+        old = self.ids[slot]
+        if old > message_id:
+            return
+        if old and old < message_id and message_id - old < self.horizon and self.capacity < self.horizon:
+            self._grow()
+            slot = message_id % self.capacity
+            old = self.ids[slot]
+            if old > message_id:
+                return
+        if not old:
+            self.size += 1
+        self.ids[slot] = message_id
+        self.authors[slot] = author_id
+        self.stamps[slot] = int(when.timestamp())
+
+    def get(self, message_id: int, now: Optional[datetime] = None) -> Optional[int]:
+        slot = message_id % self.capacity
+        if self.ids[slot] != message_id:
+            return None
+        if MESSAGE_AUTHOR_MAX_AGE is not None:
+            now = now or now_utc()
+            if now.timestamp() - self.stamps[slot] > MESSAGE_AUTHOR_MAX_AGE.total_seconds():
+                return None
+        return self.authors[slot]
+
+    def _grow(self):
+        ids, authors, stamps = self.ids, self.authors, self.stamps
+        self.__init__(self.horizon, self.capacity * 2)
+        for message_id, author_id, stamp in zip(ids, authors, stamps):
+            if message_id:
+                slot = message_id % self.capacity
+                if self.ids[slot] > message_id:
+                    continue
+                if not self.ids[slot]:
+                    self.size += 1
+                self.ids[slot] = message_id
+                self.authors[slot] = author_id
+                self.stamps[slot] = stamp
+
+    def __len__(self) -> int:
+        return self.size
+
+    def dump(self) -> Tuple[array, array, array]:
+        """Copies of the ring arrays (ids, authors, stamps), for snapshots"""
+        return array("q", self.ids), array("q", self.authors), array("I", self.stamps)
+
+    @classmethod
+    def load(cls, ids: array, authors: array, stamps: array) -> "MessageAuthorIndex":
+        index = cls()
+        index.capacity = len(ids)
+        index.ids, index.authors, index.stamps = ids, authors, stamps
+        index.size = len(ids) - ids.count(0)
+        return index
+
+    def memory_bytes(self) -> int:
+        return sum(a.buffer_info()[1] * a.itemsize for a in (self.ids, self.authors, self.stamps))
+
+class PostReactions:
+    """Reactions on one message: running total plus per-reactor counts"""
+    __slots__ = ("total", "reactors")
+
+    def __init__(self):
+        self.total = 0
+        self.reactors: Dict[int, int] = {}
+
+    def add(self, reactor_id: int, delta: int):
+        old = self.reactors.get(reactor_id, 0)
+        new = max(0, old + delta)
+        if new:
+            self.reactors[reactor_id] = new
+        else:
+            self.reactors.pop(reactor_id, None)
+        self.total += new - old
+
+class TopKPosts:
+    """The K most reacted posts of a chat, as an indexed min-heap.
+
+    The heap root is the weakest kept post, so a new candidate is compared
+    against it in O(1). `pos` maps message_id -> heap slot, letting a post's
+    score move up or down in place (O(log K)) instead of appending duplicates.
+    """
+    __slots__ = ("k", "heap", "pos")
+
+    def __init__(self, k: int = MOST_LOVED_TOP_K):
+        self.k = k
+        self.heap: List[List[int]] = []  # [reactions, message_id, author_id]
+        self.pos: Dict[int, int] = {}
+
+    def update(self, message_id: int, author_id: int, reactions: int):
+        i = self.pos.get(message_id)
+        if reactions <= 0:  # Posts without reactions are never listed
+            if i is not None:
+                self.remove(message_id)
+        elif i is not None:
+            old = self.heap[i][0]
+            self.heap[i][0] = reactions
+            if reactions < old:
+                self._sift_up(i)
+            else:
+                self._sift_down(i)
+        elif len(self.heap) < self.k:
+            self.heap.append([reactions, message_id, author_id])
+            self.pos[message_id] = len(self.heap) - 1
+            self._sift_up(len(self.heap) - 1)
+        elif reactions > self.heap[0][0]:
+            del self.pos[self.heap[0][1]]
+            self.heap[0] = [reactions, message_id, author_id]
+            self.pos[message_id] = 0
+            self._sift_down(0)
+
+    def remove(self, message_id: int):
+        i = self.pos[message_id]
+        last = len(self.heap) - 1
+        if i != last:
+            self._swap(i, last)
+        del self.pos[self.heap.pop()[1]]
+        if i < len(self.heap):
+            self._sift_up(i)
+            self._sift_down(i)
+
+    def top(self) -> List[Tuple[int, int, int]]:
+        """(message_id, author_id, reactions), best first"""
+        return [(m, a, r) for r, m, a in sorted(self.heap, reverse=True)]
+
+    def clear(self):
+        self.heap.clear()
+        self.pos.clear()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def _swap(self, i: int, j: int):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.pos[heap[i][1]] = i
+        self.pos[heap[j][1]] = j
+
+    def _sift_up(self, i: int):
+        while i:
+            parent = (i - 1) >> 1
+            if self.heap[i][0] >= self.heap[parent][0]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i: int):
+        n = len(self.heap)
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and self.heap[child + 1][0] < self.heap[child][0]:
+                child += 1
+            if self.heap[i][0] <= self.heap[child][0]:
+                break
+            self._swap(i, child)
+            i = child
+
+def evict_post_reactions(chat_id: int, now: Optional[datetime] = None) -> int:
+    """Drop reaction records for messages that fell out of the author index.
+
+    Reactions to those messages are no longer credited, so their records can
+    never change again. Returns the number of records dropped.
+    """
+    now = now or now_utc()
+    index = message_authors.get(chat_id)
+    posts = post_reactions.get(chat_id)
+    if not posts:
+        return 0
+    if index is None:
+        dropped = len(posts)
+        posts.clear()
+        return dropped
+    stale = [message_id for message_id in posts if index.get(message_id, now) is None]
+    for message_id in stale:
+        del posts[message_id]
+    return len(stale)
+
+def message_index_report() -> str:
+    """Per-chat size and memory of the message author index"""
+    lines = [f"chat {chat_id}: {len(index)} msgs / {index.capacity} slots, {index.memory_bytes() / 1024:.1f} KiB, "
+             f"{len(post_reactions.get(chat_id, ()))} reacted posts"
+             for chat_id, index in message_authors.items()]
+    total = sum(index.memory_bytes() for index in message_authors.values())
+    lines.append(f"total: {len(message_authors)} chats, {total / 1024:.1f} KiB")
+    return "\n".join(lines)
+
+# ========= RANKED SCORES =========
+RANK_MAX_LEVEL = 24  # Enough for ~2^48 entries at p = 1/4
+
+def _rank_level() -> int:
+    level = 1
+    while level < RANK_MAX_LEVEL and random.random() < 0.25:
+        level += 1
+    return level
+
+class RankIndex:
+    """Indexable skip list of unique, sortable keys.
+
+    Nodes are [key, next links, link widths]; a link's width is how many
+    positions it skips, so rank lookups add widths on the way down in
+    O(log n) and the first n keys are a walk along the bottom level.
+    """
+    __slots__ = ("head", "level", "size")
+
+    def __init__(self):
+        self.head = [None, [None] * RANK_MAX_LEVEL, [1] * RANK_MAX_LEVEL]
+        self.level = 1
+        self.size = 0
+
+    def insert(self, key):
+        update = [self.head] * RANK_MAX_LEVEL
+        steps = [0] * RANK_MAX_LEVEL
+        node, pos = self.head, 0
+        for lvl in range(self.level - 1, -1, -1):
+            nxt = node[1][lvl]
+            while nxt is not None and nxt[0] < key:
+                pos += node[2][lvl]
+                node, nxt = nxt, nxt[1][lvl]
+            update[lvl], steps[lvl] = node, pos
+        height = _rank_level()
+        if height > self.level:
+            for lvl in range(self.level, height):
+                self.head[2][lvl] = self.size + 1
+            self.level = height
+        new = [key, [None] * height, [0] * height]
+        for lvl in range(height):
+            prev = update[lvl]
+            distance = pos - steps[lvl] + 1
+            new[1][lvl], prev[1][lvl] = prev[1][lvl], new
+            new[2][lvl] = prev[2][lvl] - distance + 1
+            prev[2][lvl] = distance
+        for lvl in range(height, self.level):
+            update[lvl][2][lvl] += 1
+        self.size += 1
+
+    def remove(self, key):
+        update = [self.head] * RANK_MAX_LEVEL
+        node = self.head
+        for lvl in range(self.level - 1, -1, -1):
+            nxt = node[1][lvl]
+            while nxt is not None and nxt[0] < key:
+                node, nxt = nxt, nxt[1][lvl]
+            update[lvl] = node
+        target = update[0][1][0]
+        if target is None or target[0] != key:
+            raise KeyError(key)
+        for lvl in range(self.level):
+            prev = update[lvl]
+            if prev[1][lvl] is target:
+                prev[2][lvl] += target[2][lvl] - 1
+                prev[1][lvl] = target[1][lvl]
+            else:
+                prev[2][lvl] -= 1
+        self.size -= 1
+
+    def rank(self, key) -> Optional[int]:
+        """1-based position of key, or None"""
+        node, pos = self.head, 0
+        for lvl in range(self.level - 1, -1, -1):
+            nxt = node[1][lvl]
+            while nxt is not None and nxt[0] <= key:
+                pos += node[2][lvl]
+                node, nxt = nxt, nxt[1][lvl]
+        return pos if node is not self.head and node[0] == key else None
+
+    def first(self, n: int) -> list:
+        keys = []
+        node = self.head[1][0]
+        while node is not None and len(keys) < n:
+            keys.append(node[0])
+            node = node[1][0]
+        return keys
+
+    def build(self, keys: list):
+        """Replace the contents with already sorted keys in O(n)"""
+        self.__init__()
+        last = [self.head] * RANK_MAX_LEVEL
+        last_pos = [0] * RANK_MAX_LEVEL
+        level = 1
+        for pos, key in enumerate(keys, 1):
+            height = _rank_level()
+            node = [key, [None] * height, [0] * height]
+            for lvl in range(height):
+                last[lvl][1][lvl] = node
+                last[lvl][2][lvl] = pos - last_pos[lvl]
+                last[lvl], last_pos[lvl] = node, pos
+            if height > level:
+                level = height
+        self.level = level
+        self.size = len(keys)
+        for lvl in range(RANK_MAX_LEVEL):
+            last[lvl][2][lvl] = self.size + 1 - last_pos[lvl]
+
+    def __len__(self) -> int:
+        return self.size
+
+# Rank keys pack (-score, user_id) into one int so the skip list compares
+# plain ints: higher score first, then lower user id.
+_RANK_UID_BITS = 64
+_RANK_UID_MASK = (1 << _RANK_UID_BITS) - 1
+
+def _rank_key(user_id: int, score: int) -> int:
+    return (-score << _RANK_UID_BITS) | (user_id & _RANK_UID_MASK)
+
+class RankedScores(dict):
+    """user_id -> score for one chat, with a rank index and running total kept in step.
+
+    Every write path (+=, update, pop, clear) goes through the overrides, so
+    restores, replays and resets keep the index consistent. The index is
+    built on the first ranking query (restores don't pay for it) and then
+    maintained per write. Reading a missing user returns 0 without inserting it.
+    """
+    __slots__ = ("_index", "total")
+
+    def __init__(self):
+        super().__init__()
+        self._index: Optional[RankIndex] = None
+        self.total = 0
+
+    def __missing__(self, user_id: int) -> int:
+        return 0
+
+    def __setitem__(self, user_id: int, score: int):
+        old = dict.get(self, user_id)
+        if old is not None:
+            if old == score:
+                return
+            if self._index is not None:
+                self._index.remove(_rank_key(user_id, old))
+            self.total -= old
+        dict.__setitem__(self, user_id, score)
+        if self._index is not None:
+            self._index.insert(_rank_key(user_id, score))
+        self.total += score
+
+    def __delitem__(self, user_id: int):
+        score = dict.pop(self, user_id)
+        if self._index is not None:
+            self._index.remove(_rank_key(user_id, score))
+        self.total -= score
+
+    @property
+    def index(self) -> RankIndex:
+        if self._index is None:
+            self._index = RankIndex()
+            self._index.build(sorted(map(_rank_key, self.keys(), self.values())))
+        return self._index
+
+    def pop(self, user_id: int, *default):
+        if user_id in self:
+            score = dict.__getitem__(self, user_id)
+            del self[user_id]
+            return score
+        if default:
+            return default[0]
+        raise KeyError(user_id)
+
+    def setdefault(self, user_id: int, default: int = 0) -> int:
+        if user_id not in self:
+            self[user_id] = default
+        return dict.__getitem__(self, user_id)
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        if self:
+            for user_id, score in items.items():
+                self[user_id] = score
+            return
+        dict.update(self, items)
+        self._index = None
+        self.total = sum(items.values())
+
+    def clear(self):
+        dict.clear(self)
+        self._index = None
+        self.total = 0
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        """The n best (user_id, score), highest first"""
+        return [(key & _RANK_UID_MASK, -(key >> _RANK_UID_BITS)) for key in self.index.first(n)]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """1-based rank of a user, or None if they have no score"""
+        score = dict.get(self, user_id)
+        return None if score is None else self.index.rank(_rank_key(user_id, score))
+
+# ========= ROLLING WINDOWS =========
+_BUCKET_SECONDS = ROLLING_BUCKET.total_seconds()
+_DAY_BUCKETS = int(DAILY_WINDOW / ROLLING_BUCKET)
+_RING_BUCKETS = int(WEEKLY_WINDOW / ROLLING_BUCKET)
+
+_rolling_generation = 0  # Bumped by each snapshot capture; see RollingCounter._own()
+_rolling_state = attrgetter("bucket", "day", "week", "buckets")
+
+def bucket_of(when: datetime) -> int:
+    return int(when.timestamp() // _BUCKET_SECONDS)
+
+class RollingCounter:
+    """Counts over the last DAILY_WINDOW and WEEKLY_WINDOW for one user.
+
+    A fixed ring of WEEKLY_WINDOW / ROLLING_BUCKET buckets plus running sums
+    for both windows. Moving to a newer bucket subtracts the buckets that
+    fall out of each window, so reads and writes are O(1) amortized and the
+    memory per user is constant. A snapshot captures state() by reference;
+    the ring is copied on the first write after that (copy-on-write).
+    """
+
+    __slots__ = ("bucket", "day", "week", "buckets", "generation")
+
+    def __init__(self):
+        self.bucket = 0  # Newest bucket seen
+        self.day = 0
+        self.week = 0
+        self.buckets = array("I", bytes(4 * _RING_BUCKETS))
+        self.generation = _rolling_generation
+
+    def _own(self):
+        """Copy the ring before writing to it if a snapshot may still hold it"""
+        if self.generation != _rolling_generation:
+            self.buckets = array("I", self.buckets)
+            self.generation = _rolling_generation
+
+    def advance(self, bucket: int):
+        if bucket <= self.bucket:
+            return
+        self._own()
+        if bucket - self.bucket >= _RING_BUCKETS:
+            self.buckets = array("I", bytes(4 * _RING_BUCKETS))
+            self.day = self.week = 0
+        else:
+            buckets = self.buckets
+            for b in range(self.bucket + 1, bucket + 1):
+                self.day -= buckets[(b - _DAY_BUCKETS) % _RING_BUCKETS]
+                i = b % _RING_BUCKETS
+                self.week -= buckets[i]
+                buckets[i] = 0
+        self.bucket = bucket
+
+    def add(self, bucket: int, n: int):
+        self.advance(bucket)
+        age = self.bucket - bucket  # > 0 only for late (replayed) events
+        if age >= _RING_BUCKETS:
+            return
+        self._own()
+        self.buckets[bucket % _RING_BUCKETS] += n
+        self.week += n
+        if age < _DAY_BUCKETS:
+            self.day += n
+
+    def counts(self, bucket: int) -> Tuple[int, int]:
+        """(last DAILY_WINDOW, last WEEKLY_WINDOW) as of `bucket`"""
+        self.advance(bucket)
+        return self.day, self.week
+
+    def state(self) -> tuple:
+        return _rolling_state(self)
+
+    def dump(self) -> Optional[list]:
+        return RollingCounter.dump_state(_rolling_state(self))
+
+    @staticmethod
+    def dump_state(state: tuple) -> Optional[list]:
+        """[newest bucket, day, week, compressed ring], or None if the week is empty"""
+        bucket, day, week, buckets = state
+        if not week:
+            return None
+        return [bucket, day, week, base64.b64encode(zlib.compress(buckets.tobytes())).decode()]
+
+    @classmethod
+    def load(cls, data: list) -> "RollingCounter":
+        counter = cls()
+        if len(data) == 2:  # Older [newest bucket, [[bucket, count], ...]] format
+            counter.bucket = data[0]
+            for b, n in data[1]:
+                counter.add(b, n)
+            return counter
+        counter.bucket, counter.day, counter.week, ring = data
+        counter.buckets = array("I")
+        counter.buckets.frombytes(zlib.decompress(base64.b64decode(ring)))
+        return counter
+
 # ========= STATE (in-memory) =========
 known_chats: Set[int] = set()
 last_activity_utc: Dict[int, Dict[int, datetime]] = defaultdict(dict)
-total_content_count: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
-daily_content_count: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
-weekly_content_count: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+total_content_count: Dict[int, RankedScores] = defaultdict(RankedScores)
+daily_content_count: Dict[int, RankedScores] = defaultdict(RankedScores)
+weekly_content_count: Dict[int, RankedScores] = defaultdict(RankedScores)
 warned_48h: Dict[int, Set[int]] = defaultdict(set)
 new_member_deadline: Dict[int, Dict[int, datetime]] = defaultdict(dict)
 new_member_warned: Dict[int, Set[int]] = defaultdict(set)
@@ -283,10 +870,13 @@ last_post_date: Dict[int, Dict[int, datetime]] = defaultdict(dict)
 content_type_count: Dict[int, Dict[int, Dict[str, int]]] = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
 
 # Reaction tracking
-post_reactions: Dict[int, Dict[int, Dict[str, int]]] = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-weekly_most_loved: Dict[int, List[Tuple[int, int, int, str]]] = defaultdict(list)
-message_authors: Dict[int, Dict[int, int]] = defaultdict(dict)
-weekly_reaction_totals: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+post_reactions: Dict[int, Dict[int, PostReactions]] = defaultdict(dict)  # chat_id -> message_id -> reactions
+weekly_most_loved: Dict[int, TopKPosts] = defaultdict(TopKPosts)
+message_authors: Dict[int, MessageAuthorIndex] = defaultdict(MessageAuthorIndex)
+weekly_reaction_totals: Dict[int, RankedScores] = defaultdict(RankedScores)
+reactions_given: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))  # Posts each user has reacted to (Love Giver)
+rolling_posts: Dict[int, Dict[int, RollingCounter]] = defaultdict(dict)  # Posts in the last 24h/7d
+rolling_ranks: Dict[int, Tuple[int, RankedScores, RankedScores]] = {}  # chat_id -> (bucket, 24h, 7d) standings
 
 # Economy & Rewards System
 user_coins: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
@@ -299,6 +889,12 @@ weekly_challenge_progress: Dict[int, Dict[int, Dict[str, int]]] = defaultdict(la
 weekly_challenge_completed: Dict[int, Dict[int, Set[str]]] = defaultdict(lambda: defaultdict(set))
 current_weekly_challenges: Set[str] = set()
 
+# Daily/weekly periods: the reset jobs only advance the epoch; each chat's
+# period counters are reset lazily on its first update in the new epoch
+period_epochs: Dict[str, int] = {"daily": 0, "weekly": 0}
+chat_epochs: Dict[int, Dict[str, int]] = {}  # chat_id -> epoch its period counters belong to
+period_boundaries: Dict[str, float] = {}  # period -> timestamp of the last boundary already reset
+
 # User join dates for badges
 user_join_dates: Dict[int, Dict[int, datetime]] = defaultdict(dict)
 
@@ -331,7 +927,7 @@ class Ach:
 achievements: Dict[int, Dict[int, Set[str]]] = defaultdict(lambda: defaultdict(set))
 
 # === XP & Levels ===
-xp_levels: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+xp_levels: Dict[int, RankedScores] = defaultdict(RankedScores)
 
 def calc_level(xp: int) -> int:
     return int((xp ** 0.5) // 1)
@@ -379,6 +975,8 @@ def get_user_referral_code(chat_id: int, user_id: int) -> str:
     """Get or create a referral code for a user"""
     if user_id not in user_referral_codes[chat_id]:
         user_referral_codes[chat_id][user_id] = generate_referral_code(user_id, chat_id)
+        touch(chat_id, user_id)
+        record(Ev.ReferralCode, chat_id, user_id, text=user_referral_codes[chat_id][user_id])
     return user_referral_codes[chat_id][user_id]
 
 def find_user_by_referral_code(chat_id: int, code: str) -> int:
@@ -388,6 +986,1361 @@ def find_user_by_referral_code(chat_id: int, code: str) -> int:
             return user_id
     return None
 
+# ========= PERSISTENCE =========
+# The module-level dicts above stay the hot read path; a store mirrors them to
+# disk so the bot survives restarts. Mutations mark (chat, user) rows dirty via
+# touch() and a write-behind buffer coalesces them into batched transactions.
+
+MEMBER_COLUMNS = (
+    "chat_id", "user_id", "total", "daily", "weekly", "xp", "coins", "streak",
+    "weekly_reactions", "weekly_referrals", "last_activity", "last_post", "join_date",
+    "new_member_deadline", "new_member_warned", "warned_48h", "title",
+    "referral_code", "referrer_id", "milestone_claimed", "data", "updated_at",
+)
+
+SQL_SCHEMA = (
+    f"CREATE TABLE IF NOT EXISTS members ("
+    f"chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+    f"{', '.join(MEMBER_COLUMNS[2:])}, "
+    f"PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS idx_members_referrer ON members (chat_id, referrer_id)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+)
+SQL_UPSERT_MEMBER = (
+    f"INSERT OR REPLACE INTO members ({', '.join(MEMBER_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(MEMBER_COLUMNS))})"
+)
+SQL_SELECT_MEMBERS = f"SELECT {', '.join(MEMBER_COLUMNS)} FROM members"
+SQL_SELECT_MEMBERS_SINCE = f"{SQL_SELECT_MEMBERS} WHERE updated_at >= ?"
+SQL_UPSERT_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+SQL_SELECT_META = "SELECT key, value FROM meta"
+
+# Every per-(chat, user) table, used to enumerate the members of a chat
+MEMBER_TABLES = (
+    last_activity_utc, total_content_count, daily_content_count, weekly_content_count,
+    new_member_deadline, user_streaks, last_post_date, content_type_count,
+    weekly_reaction_totals, user_coins, user_titles, user_inventory, active_boosts,
+    weekly_challenge_progress, weekly_challenge_completed, user_join_dates,
+    user_referral_codes, referral_relationships, referral_stats, weekly_referral_count,
+    achievements, xp_levels, reactions_given, rolling_posts,
+)
+# The collection-valued per-member tables, in member_data() order
+NESTED_TABLES = (
+    achievements, user_inventory, active_boosts, content_type_count,
+    weekly_challenge_progress, weekly_challenge_completed, referral_stats, reactions_given,
+    rolling_posts,
+)
+
+def _peek(table, chat_id: int, user_id: int, default=None):
+    """Read a per-user value without creating defaultdict entries"""
+    return table.get(chat_id, {}).get(user_id, default)
+
+def _ts(dt: Optional[datetime]) -> Optional[float]:
+    return dt.timestamp() if dt is not None else None
+
+def _dt(ts: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(ts, UTC) if ts is not None else None
+
+def chat_members(chat_id: int) -> Set[int]:
+    """All user ids that have any state in a chat"""
+    members = set(warned_48h.get(chat_id, ())) | new_member_warned.get(chat_id, set())
+    for table in MEMBER_TABLES:
+        members.update(table.get(chat_id, ()))
+    return members
+
+def forget_member(chat_id: int, user_id: int):
+    """Drop all in-memory state of one (chat, user)"""
+    for table in MEMBER_TABLES:
+        table.get(chat_id, {}).pop(user_id, None)
+    for table in (warned_48h, new_member_warned):
+        table.get(chat_id, set()).discard(user_id)
+    claimed = referral_milestones_claimed.get(chat_id, set())
+    claimed.difference_update([pair for pair in claimed if pair[1] == user_id])
+    rolling_ranks.pop(chat_id, None)
+
+def member_data(tables: tuple, user_id: int) -> dict:
+    """The nested (collection-valued) part of a member's state, JSON-ready.
+
+    `tables` are one chat's entries of NESTED_TABLES: the live dicts, or the
+    copies capture_chat takes so a snapshot can be encoded off the loop.
+    """
+    achs, inventory, boosts, content_types, progress, completed, ref_stats, given, rolling = tables
+    return {
+        "achievements": sorted(achs.get(user_id, ())),
+        "inventory": list(inventory.get(user_id, ())),
+        "boosts": {k: v.timestamp() for k, v in boosts.get(user_id, {}).items()},
+        "content_types": dict(content_types.get(user_id, {})),
+        "challenge_progress": dict(progress.get(user_id, {})),
+        "challenge_completed": sorted(completed.get(user_id, ())),
+        "referral_stats": ref_stats.get(user_id),
+        "reactions_given": given.get(user_id, 0),
+        "rolling_posts": _dump_rolling(rolling[user_id]) if user_id in rolling else None,
+    }
+
+def _dump_rolling(value) -> list:
+    """Dump a live RollingCounter or a state() captured by capture_chat"""
+    return value.dump() if isinstance(value, RollingCounter) else RollingCounter.dump_state(value)
+
+def dump_member_data(chat_id: int, user_id: int) -> dict:
+    return member_data(tuple(table.get(chat_id, {}) for table in NESTED_TABLES), user_id)
+
+def load_member_data(chat_id: int, user_id: int, data: dict):
+    if data.get("achievements"):
+        achievements[chat_id][user_id].update(data["achievements"])
+    if data.get("inventory"):
+        user_inventory[chat_id][user_id].extend(data["inventory"])
+    for boost_type, expiry in data.get("boosts", {}).items():
+        active_boosts[chat_id][user_id][boost_type] = _dt(expiry)
+    for content_type, count in data.get("content_types", {}).items():
+        content_type_count[chat_id][user_id][content_type] = count
+    for challenge_id, progress in data.get("challenge_progress", {}).items():
+        weekly_challenge_progress[chat_id][user_id][challenge_id] = progress
+    if data.get("challenge_completed"):
+        weekly_challenge_completed[chat_id][user_id].update(data["challenge_completed"])
+    if data.get("referral_stats"):
+        referral_stats[chat_id][user_id].update(data["referral_stats"])
+    if data.get("reactions_given"):
+        reactions_given[chat_id][user_id] = data["reactions_given"]
+    if data.get("rolling_posts"):
+        rolling_posts[chat_id][user_id] = RollingCounter.load(data["rolling_posts"])
+
+def dump_member(chat_id: int, user_id: int, updated_at: float) -> tuple:
+    """Serialize one (chat, user) into a members row"""
+    referrer_id = _peek(referral_relationships, chat_id, user_id)
+    data = dump_member_data(chat_id, user_id)
+    data["epochs"] = chat_epochs.get(chat_id, period_epochs)  # Periods the daily/weekly columns belong to
+    return (
+        chat_id,
+        user_id,
+        _peek(total_content_count, chat_id, user_id, 0),
+        _peek(daily_content_count, chat_id, user_id, 0),
+        _peek(weekly_content_count, chat_id, user_id, 0),
+        _peek(xp_levels, chat_id, user_id, 0),
+        _peek(user_coins, chat_id, user_id, 0),
+        _peek(user_streaks, chat_id, user_id, 0),
+        _peek(weekly_reaction_totals, chat_id, user_id, 0),
+        _peek(weekly_referral_count, chat_id, user_id, 0),
+        _ts(_peek(last_activity_utc, chat_id, user_id)),
+        _ts(_peek(last_post_date, chat_id, user_id)),
+        _ts(_peek(user_join_dates, chat_id, user_id)),
+        _ts(_peek(new_member_deadline, chat_id, user_id)),
+        int(user_id in new_member_warned.get(chat_id, ())),
+        int(user_id in warned_48h.get(chat_id, ())),
+        _peek(user_titles, chat_id, user_id),
+        _peek(user_referral_codes, chat_id, user_id),
+        referrer_id,
+        int(referrer_id is not None and (referrer_id, user_id) in referral_milestones_claimed.get(chat_id, ())),
+        json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+        updated_at,
+    )
+
+def load_member(row: tuple):
+    """Apply a members row to the in-memory state, skipping default values"""
+    (chat_id, user_id, total, daily, weekly, xp, coins, streak, weekly_reactions,
+     weekly_referrals, last_activity, last_post, join_date, deadline, nm_warned,
+     warned, title, referral_code, referrer_id, milestone_claimed, data, _) = row
+    data = json.loads(data) if data else {}
+    # A period reset does not rewrite rows: counters written before the
+    # chat's current epoch are stale and read as zero (rows without epochs
+    # predate this and are taken as current).
+    current = chat_epochs.get(chat_id, period_epochs)
+    epochs = data.pop("epochs", current)
+    if epochs.get("daily", 0) < current.get("daily", 0):
+        daily = 0
+    if epochs.get("weekly", 0) < current.get("weekly", 0):
+        weekly = weekly_reactions = weekly_referrals = 0
+        data.pop("challenge_progress", None)
+        data.pop("challenge_completed", None)
+    # Presence in the daily/weekly dicts means "active this period", so only
+    # non-zero counters are restored.
+    for table, value in (
+        (total_content_count, total), (daily_content_count, daily),
+        (weekly_content_count, weekly), (xp_levels, xp), (user_coins, coins),
+        (user_streaks, streak), (weekly_reaction_totals, weekly_reactions),
+        (weekly_referral_count, weekly_referrals),
+    ):
+        if value:
+            table[chat_id][user_id] = value
+    for table, value in (
+        (last_activity_utc, last_activity), (last_post_date, last_post),
+        (user_join_dates, join_date), (new_member_deadline, deadline),
+    ):
+        if value is not None:
+            table[chat_id][user_id] = _dt(value)
+    if nm_warned:
+        new_member_warned[chat_id].add(user_id)
+    if warned:
+        warned_48h[chat_id].add(user_id)
+    if title is not None:
+        user_titles[chat_id][user_id] = title
+    if referral_code is not None:
+        user_referral_codes[chat_id][user_id] = referral_code
+    if referrer_id is not None:
+        referral_relationships[chat_id][user_id] = referrer_id
+        if milestone_claimed:
+            referral_milestones_claimed[chat_id].add((referrer_id, user_id))
+    if data:
+        load_member_data(chat_id, user_id, data)
+
+def reload_member(row: tuple):
+    """Replace a member's in-memory state with a newer row"""
+    forget_member(row[0], row[1])
+    load_member(row)
+
+def dump_meta() -> Dict[str, str]:
+    return {
+        "known_chats": json.dumps(sorted(known_chats)),
+        "current_weekly_challenges": json.dumps(sorted(current_weekly_challenges)),
+        "period_epochs": json.dumps(period_epochs),
+        "chat_epochs": json.dumps(chat_epochs),
+        "period_boundaries": json.dumps(period_boundaries),
+    }
+
+def load_meta(meta: Dict[str, str]):
+    global current_weekly_challenges
+    known_chats.update(json.loads(meta.get("known_chats", "[]")))
+    challenges = set(json.loads(meta.get("current_weekly_challenges", "[]")))
+    if challenges:
+        current_weekly_challenges = challenges & set(WEEKLY_CHALLENGES)
+    period_epochs.update(json.loads(meta.get("period_epochs", "{}")))
+    chat_epochs.update((int(k), v) for k, v in json.loads(meta.get("chat_epochs", "{}")).items())
+    period_boundaries.update(json.loads(meta.get("period_boundaries", "{}")))
+
+class MemoryStore:
+    """Keeps state in process memory only; nothing survives a restart"""
+    name = "memory"
+    wants_rows = False  # Whether write() needs the dirty members serialized
+
+    def load(self, since: Optional[float] = None):
+        pass
+
+    def write(self, members: List[tuple], meta: Dict[str, str]):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteStore(MemoryStore):
+    """SQLite (WAL) backed store; one row per (chat, user) plus a small meta table"""
+    name = "sqlite"
+    wants_rows = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for stmt in SQL_SCHEMA:
+            self.conn.execute(stmt)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(members)")}
+        if "updated_at" not in columns:
+            self.conn.execute("ALTER TABLE members ADD COLUMN updated_at")
+
+    def load(self, since: Optional[float] = None):
+        """Load all rows, or only rows written since a snapshot was captured"""
+        load_meta(dict(self.conn.execute(SQL_SELECT_META)))
+        if since is None:
+            for row in self.conn.execute(SQL_SELECT_MEMBERS):
+                load_member(row)
+            return
+        for row in self.conn.execute(SQL_SELECT_MEMBERS_SINCE, (since,)):
+            if not defer_until_hydrated(row[0], partial(reload_member, row)):
+                reload_member(row)
+
+    def write(self, members: List[tuple], meta: Dict[str, str]):
+        if not members and not meta:
+            return
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(SQL_UPSERT_MEMBER, members)
+                self.conn.executemany(SQL_UPSERT_META, meta.items())
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def open_store() -> MemoryStore:
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(STORAGE_PATH)
+    if STORAGE_BACKEND == "eventlog":
+        return EventLogStore(EVENT_LOG_DIR)
+    if STORAGE_BACKEND == "memory":
+        return MemoryStore()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+store: MemoryStore = MemoryStore()
+
+class WriteBehindBuffer:
+    """Coalesces dirty (chat, user) keys and writes them in batches.
+
+    A flush happens every PERSIST_FLUSH_INTERVAL or as soon as
+    PERSIST_FLUSH_MAX_UPDATES updates have been handled since the last one,
+    whichever comes first. Only one flush is in flight at a time, so a crash
+    loses at most one interval (plus one in-flight write) of changes. Rows
+    are serialized PERSIST_DRAIN_BATCH at a time, yielding to the event loop
+    in between, so a large batch does not stall update handling.
+    """
+
+    def __init__(self, max_updates: int):
+        self.max_updates = max_updates
+        self.dirty: Set[Tuple[int, int]] = set()
+        self.meta_dirty = False
+        self.updates_since_flush = 0
+        self._in_flight = False
+        self._task: Optional[asyncio.Task] = None
+        # Metrics
+        self.flushes = 0
+        self.failures = 0
+        self.rows_written = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.last_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.total_latency_ms = 0.0
+
+    def note_update(self):
+        self.updates_since_flush += 1
+        if self.updates_since_flush >= self.max_updates and not self._in_flight:
+            self._task = asyncio.get_running_loop().create_task(self.flush())
+
+    def _take(self) -> Tuple[List[Tuple[int, int]], Dict[str, str]]:
+        keys = list(self.dirty) if store.wants_rows else []
+        meta = dump_meta() if self.meta_dirty else {}
+        self.dirty.clear()
+        self.meta_dirty = False
+        self.updates_since_flush = 0
+        return keys, meta
+
+    def _drain(self) -> Tuple[List[tuple], Dict[str, str]]:
+        keys, meta = self._take()
+        drained_at = now_utc().timestamp()
+        return [dump_member(cid, uid, drained_at) for cid, uid in keys], meta
+
+    async def _drain_batched(self) -> Tuple[List[tuple], Dict[str, str]]:
+        """Like _drain, but yields to the event loop every PERSIST_DRAIN_BATCH rows.
+
+        A row changed after its batch was serialized is marked dirty again
+        by touch() and goes out with the next flush.
+        """
+        keys, meta = self._take()
+        drained_at = now_utc().timestamp()
+        rows = []
+        try:
+            for start in range(0, len(keys), PERSIST_DRAIN_BATCH):
+                if start:
+                    await asyncio.sleep(0)
+                rows.extend(dump_member(cid, uid, drained_at) for cid, uid in keys[start:start + PERSIST_DRAIN_BATCH])
+        except BaseException:
+            self.dirty.update(keys)
+            self.meta_dirty = self.meta_dirty or bool(meta)
+            raise
+        return rows, meta
+
+    def _requeue(self, rows: List[tuple], meta: Dict[str, str]):
+        self.failures += 1
+        self.dirty.update((row[0], row[1]) for row in rows)
+        self.meta_dirty = self.meta_dirty or bool(meta)
+
+    def _record(self, batch: int, latency_ms: float):
+        self.flushes += 1
+        self.rows_written += batch
+        self.last_batch = batch
+        self.max_batch = max(self.max_batch, batch)
+        self.last_latency_ms = latency_ms
+        self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+        self.total_latency_ms += latency_ms
+
+    async def flush(self):
+        """Write the pending batch from a worker thread"""
+        if self._in_flight or (not self.dirty and not self.meta_dirty):
+            return
+        self._in_flight = True
+        try:
+            rows, meta = await self._drain_batched()
+            started = perf_counter()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, store.write, rows, meta)
+            except Exception as e:
+                print(f"Persist fail ({len(rows)} rows): {e}")
+                self._requeue(rows, meta)
+                return
+            self._record(len(rows), (perf_counter() - started) * 1000)
+        finally:
+            self._in_flight = False
+
+    def flush_sync(self):
+        """Blocking flush, used on shutdown"""
+        if not self.dirty and not self.meta_dirty:
+            return
+        rows, meta = self._drain()
+        started = perf_counter()
+        try:
+            store.write(rows, meta)
+        except Exception as e:
+            print(f"Persist fail ({len(rows)} rows): {e}")
+            self._requeue(rows, meta)
+            return
+        self._record(len(rows), (perf_counter() - started) * 1000)
+
+    def summary(self) -> str:
+        avg_latency = self.total_latency_ms / self.flushes if self.flushes else 0.0
+        avg_batch = self.rows_written / self.flushes if self.flushes else 0.0
+        return (
+            f"flushes={self.flushes} failures={self.failures} pending={len(self.dirty)} "
+            f"batch(last/avg/max)={self.last_batch}/{avg_batch:.1f}/{self.max_batch} "
+            f"latency_ms(last/avg/max)={self.last_latency_ms:.1f}/{avg_latency:.1f}/{self.max_latency_ms:.1f}"
+        )
+
+write_behind = WriteBehindBuffer(PERSIST_FLUSH_MAX_UPDATES)
+
+def touch(chat_id: int, user_id: int):
+    """Mark a (chat, user) row as changed so it is written on the next flush"""
+    write_behind.dirty.add((chat_id, user_id))
+
+def touch_meta():
+    write_behind.meta_dirty = True
+
+async def persist_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs after the regular handlers; counts updates towards the next flush"""
+    write_behind.note_update()
+
+async def job_flush_state(context: ContextTypes.DEFAULT_TYPE):
+    if event_log is not None:
+        await asyncio.get_running_loop().run_in_executor(None, event_log.rotate_if_large)
+    await write_behind.flush()
+
+# ========= SNAPSHOTS =========
+# Compact, versioned, columnar snapshot of all member state. Layout
+# (little-endian):
+#   header  <8sHHdII  magic, version, reserved, captured_at, n_chats, meta_len
+#   meta    JSON (known chats, weekly challenges)
+#   index   n_chats x <qQQ  chat_id, block offset, block length
+#   blocks  per chat: <II n, column mask; the user id array and every
+#           non-empty column as an n-length array; then a length-prefixed
+#           JSON blob holding the sparse, collection-valued fields; then
+#           (version 2) <I slots and the message author ring as three
+#           slot-length arrays, and a length-prefixed JSON blob with the
+#           per-post reactions and the /loved heap.
+# The index lets a reader mmap the file and decode chats lazily: startup only
+# parses the header, and chats are hydrated on first use or in the background.
+
+SNAPSHOT_MAGIC = b"UTBSNAP\0"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_READABLE_VERSIONS = (1, 2)  # Version 1 lacks the chat-level section
+SNAPSHOT_HEADER = struct.Struct("<8sHHdII")
+SNAPSHOT_INDEX_ENTRY = struct.Struct("<qQQ")
+SNAPSHOT_BLOCK_HEADER = struct.Struct("<II")
+SNAPSHOT_U32 = struct.Struct("<I")
+
+# Column order is part of the file format; bump SNAPSHOT_VERSION when changing it
+SNAPSHOT_INT_TABLES = (
+    total_content_count, daily_content_count, weekly_content_count, xp_levels,
+    user_coins, user_streaks, weekly_reaction_totals, weekly_referral_count,
+    referral_relationships,
+)
+SNAPSHOT_TIME_TABLES = (last_activity_utc, last_post_date, user_join_dates, new_member_deadline)
+# How capture_chat copies the per-user values of each of NESTED_TABLES (None: immutable)
+SNAPSHOT_NESTED_COPY = (set, list, dict, dict, dict, set, dict, None, _rolling_state)
+FLAG_NEW_MEMBER_WARNED = 1
+FLAG_WARNED_48H = 2
+FLAG_MILESTONE_CLAIMED = 4
+
+_from_ts = partial(datetime.fromtimestamp, tz=UTC)
+
+def _copy_values(values: dict, copy: Optional[Callable]) -> dict:
+    if copy is None:
+        return dict(values)
+    return dict(zip(values.keys(), map(copy, values.values())))
+
+def capture_chat(chat_id: int) -> dict:
+    """Point-in-time copy of one chat, cheap enough to take on the event loop.
+
+    Only containers are copied here, mostly by C-level dict/set/list copies;
+    building the JSON-ready member data happens in encode_chat, off the loop.
+    """
+    global _rolling_generation
+    _rolling_generation += 1  # Captured rolling rings are copied before their next write
+    referrers = referral_relationships.get(chat_id, {})
+    return {
+        "ints": [dict(table.get(chat_id, ())) for table in SNAPSHOT_INT_TABLES],
+        "times": [dict(table.get(chat_id, ())) for table in SNAPSHOT_TIME_TABLES],
+        "new_member_warned": set(new_member_warned.get(chat_id, ())),
+        "warned_48h": set(warned_48h.get(chat_id, ())),
+        "milestones": {referee for referrer, referee in referral_milestones_claimed.get(chat_id, ())
+                       if referrers.get(referee) == referrer},
+        "titles": dict(user_titles.get(chat_id, ())),
+        "codes": dict(user_referral_codes.get(chat_id, ())),
+        "nested": tuple(_copy_values(table.get(chat_id, {}), copy) for table, copy in zip(NESTED_TABLES, SNAPSHOT_NESTED_COPY)),
+        "authors": message_authors[chat_id].dump() if chat_id in message_authors else None,
+        "reactions": {mid: dict(post.reactors) for mid, post in post_reactions.get(chat_id, {}).items()},
+        "loved": [list(entry) for entry in weekly_most_loved[chat_id].heap] if chat_id in weekly_most_loved else [],
+    }
+
+def encode_chat(cap: dict) -> bytes:
+    nested_users = set()
+    for table in cap["nested"]:
+        nested_users.update(table)
+    uids = cap["new_member_warned"] | cap["warned_48h"]
+    uids.update(cap["titles"], cap["codes"], nested_users)
+    for column in cap["ints"] + cap["times"]:
+        uids.update(column)
+    uids = sorted(uids)
+
+    columns = [array("q", map(column.get, uids, repeat(0))) for column in cap["ints"]]
+    columns += [array("d", (column[u].timestamp() if u in column else 0.0 for u in uids)) for column in cap["times"]]
+    columns.append(array("B", (
+        (FLAG_NEW_MEMBER_WARNED if u in cap["new_member_warned"] else 0)
+        | (FLAG_WARNED_48H if u in cap["warned_48h"] else 0)
+        | (FLAG_MILESTONE_CLAIMED if u in cap["milestones"] else 0)
+        for u in uids
+    )))
+    mask = 0
+    parts = [b"", array("q", uids).tobytes()]
+    for bit, column in enumerate(columns):
+        if any(column):
+            mask |= 1 << bit
+            parts.append(column.tobytes())
+    parts[0] = SNAPSHOT_BLOCK_HEADER.pack(len(uids), mask)
+
+    extras = {}
+    for uid in nested_users:
+        extras[uid] = {k: v for k, v in member_data(cap["nested"], uid).items() if v}
+    for key in ("titles", "codes"):
+        for uid, value in cap[key].items():
+            extras.setdefault(uid, {})[key] = value
+    blob = json.dumps({str(k): v for k, v in extras.items() if v}, ensure_ascii=False, separators=(",", ":")).encode()
+    parts.append(SNAPSHOT_U32.pack(len(blob)))
+    parts.append(blob)
+
+    ring = cap["authors"] or (array("q"), array("q"), array("I"))
+    parts.append(SNAPSHOT_U32.pack(len(ring[0])))
+    parts.extend(column.tobytes() for column in ring)
+    blob = json.dumps({"reactions": cap["reactions"], "loved": cap["loved"]}, separators=(",", ":")).encode()
+    parts.append(SNAPSHOT_U32.pack(len(blob)))
+    parts.append(blob)
+    return b"".join(parts)
+
+def encode_snapshot(path: str, captured_at: float, meta: Dict[str, str], chats: List[Tuple[int, dict]]) -> int:
+    """Write a snapshot atomically (tmp file + rename); returns its size in bytes"""
+    meta_blob = json.dumps(meta).encode()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, captured_at, len(chats), len(meta_blob)))
+        f.write(meta_blob)
+        index_pos = f.tell()
+        f.write(b"\0" * (SNAPSHOT_INDEX_ENTRY.size * len(chats)))
+        index = []
+        for chat_id, cap in chats:
+            block = encode_chat(cap)
+            index.append(SNAPSHOT_INDEX_ENTRY.pack(chat_id, f.tell(), len(block)))
+            f.write(block)
+        size = f.tell()
+        f.seek(index_pos)
+        f.write(b"".join(index))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return size
+
+class SnapshotReader:
+    """Memory-mapped snapshot; chats are decoded on demand via the index"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        magic, version, _, captured_at, n_chats, meta_len = SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC or version not in SNAPSHOT_READABLE_VERSIONS:
+            self.close()
+            raise ValueError(f"Unsupported snapshot format (magic={magic!r}, version={version})")
+        self.version = version
+        self.captured_at = captured_at
+        pos = SNAPSHOT_HEADER.size
+        self.meta = json.loads(self._mm[pos:pos + meta_len])
+        self.chat_epochs = {int(k): v for k, v in json.loads(self.meta.get("chat_epochs", "{}")).items()}
+        pos += meta_len
+        self.index: Dict[int, Tuple[int, int]] = {}
+        for chat_id, offset, length in SNAPSHOT_INDEX_ENTRY.iter_unpack(self._mm[pos:pos + SNAPSHOT_INDEX_ENTRY.size * n_chats]):
+            self.index[chat_id] = (offset, length)
+
+    def load_chat(self, chat_id: int):
+        """Decode one chat's block straight into the live state"""
+        offset, length = self.index[chat_id]
+        view = memoryview(self._mm)[offset:offset + length]
+        try:
+            self._apply_block(chat_id, view)
+        finally:
+            view.release()
+        # Periods the chat rolled over since the capture (recorded in newer
+        # store meta) clear the restored counters, as the rows would be
+        snapshot_epochs = self.chat_epochs.get(chat_id, period_epochs)
+        current = chat_epochs.get(chat_id, snapshot_epochs)
+        for period, reset in (("daily", reset_daily), ("weekly", reset_weekly)):
+            if snapshot_epochs.get(period, 0) < current.get(period, 0):
+                reset(chat_id)
+
+    def _apply_block(self, chat_id: int, view: memoryview):
+        n, mask = SNAPSHOT_BLOCK_HEADER.unpack_from(view, 0)
+        pos = SNAPSHOT_BLOCK_HEADER.size
+        bit = 0
+
+        def read(typecode: str, length: int = n) -> array:
+            nonlocal pos
+            column = array(typecode)
+            end = pos + column.itemsize * length
+            column.frombytes(view[pos:end])
+            pos = end
+            return column
+
+        def take(typecode: str) -> Optional[array]:
+            """Next column in mask order, or None if it was empty and not written"""
+            nonlocal bit
+            present = mask & (1 << bit)
+            bit += 1
+            return read(typecode) if present else None
+
+        uids = read("q")
+        for table in SNAPSHOT_INT_TABLES:
+            column = take("q")
+            if column is not None:
+                table[chat_id].update(compress(zip(uids, column), column))
+        for table in SNAPSHOT_TIME_TABLES:
+            column = take("d")
+            if column is not None:
+                table[chat_id].update(zip(compress(uids, column), map(_from_ts, compress(column, column))))
+        flags = take("B")
+        if flags is not None:
+            for uid, flag in compress(zip(uids, flags), flags):
+                if flag & FLAG_NEW_MEMBER_WARNED:
+                    new_member_warned[chat_id].add(uid)
+                if flag & FLAG_WARNED_48H:
+                    warned_48h[chat_id].add(uid)
+                if flag & FLAG_MILESTONE_CLAIMED:
+                    referral_milestones_claimed[chat_id].add((referral_relationships[chat_id][uid], uid))
+
+        blob_len = SNAPSHOT_U32.unpack_from(view, pos)[0]
+        pos += SNAPSHOT_U32.size
+        for uid, data in json.loads(bytes(view[pos:pos + blob_len]) or b"{}").items():
+            uid = int(uid)
+            if "titles" in data:
+                user_titles[chat_id][uid] = data["titles"]
+            if "codes" in data:
+                user_referral_codes[chat_id][uid] = data["codes"]
+            load_member_data(chat_id, uid, data)
+        if self.version < 2:
+            return
+
+        pos += blob_len
+        slots = SNAPSHOT_U32.unpack_from(view, pos)[0]
+        pos += SNAPSHOT_U32.size
+        if slots:
+            message_authors[chat_id] = MessageAuthorIndex.load(read("q", slots), read("q", slots), read("I", slots))
+        blob_len = SNAPSHOT_U32.unpack_from(view, pos)[0]
+        pos += SNAPSHOT_U32.size
+        chat_data = json.loads(bytes(view[pos:pos + blob_len]))
+        posts = post_reactions[chat_id]
+        for mid, reactors in chat_data["reactions"].items():
+            post = posts[int(mid)] = PostReactions()
+            post.reactors = {int(rid): count for rid, count in reactors.items()}
+            post.total = sum(post.reactors.values())
+        for reactions, mid, author_id in chat_data["loved"]:
+            weekly_most_loved[chat_id].update(mid, author_id, reactions)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+# Lazy restore: chats still waiting to be decoded from the startup snapshot,
+# plus newer store rows / logged events that must be applied on top of them.
+_snapshot_reader: Optional[SnapshotReader] = None
+_snapshot_pending: Set[int] = set()
+_snapshot_deferred: Dict[int, List[Callable[[], None]]] = defaultdict(list)
+snapshot_meta: Dict[str, str] = {}
+
+def open_snapshot(path: str) -> Optional[float]:
+    """Map a snapshot and restore its meta; returns its capture time, or None if unusable"""
+    global _snapshot_reader
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        reader = SnapshotReader(path)
+    except Exception as e:
+        print(f"Ignoring snapshot {path}: {e}")
+        return None
+    load_meta(reader.meta)
+    snapshot_meta.update(reader.meta)
+    _snapshot_reader = reader
+    _snapshot_pending.update(reader.index)
+    print(f"Mapped snapshot {path}: {len(reader.index)} chats pending")
+    return reader.captured_at
+
+def defer_until_hydrated(chat_id: int, apply: Callable[[], None]) -> bool:
+    """Hold a state change until its chat is hydrated from the snapshot"""
+    if chat_id in _snapshot_pending:
+        _snapshot_deferred[chat_id].append(apply)
+        return True
+    return False
+
+def ensure_chat_loaded(chat_id: int):
+    if chat_id not in _snapshot_pending:
+        return
+    _snapshot_pending.discard(chat_id)
+    _snapshot_reader.load_chat(chat_id)
+    for apply in _snapshot_deferred.pop(chat_id, ()):
+        apply()
+    if not _snapshot_pending:
+        close_snapshot()
+
+def ensure_all_loaded():
+    for chat_id in list(_snapshot_pending):
+        ensure_chat_loaded(chat_id)
+
+def close_snapshot():
+    global _snapshot_reader
+    if _snapshot_reader is not None:
+        _snapshot_reader.close()
+        _snapshot_reader = None
+
+async def hydrate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before the regular handlers so an update always sees its chat's state"""
+    if update.effective_chat:
+        ensure_chat_loaded(update.effective_chat.id)
+        roll_periods(update.effective_chat.id)
+
+async def job_hydrate_snapshot(context: ContextTypes.DEFAULT_TYPE):
+    """Decode the remaining chats in the background, one chat per loop turn"""
+    started = perf_counter()
+    while _snapshot_pending:
+        ensure_chat_loaded(next(iter(_snapshot_pending)))
+        await asyncio.sleep(0)
+    print(f"Snapshot hydrated in {(perf_counter() - started) * 1000:.0f} ms")
+
+def state_chats() -> Set[int]:
+    chats = set(known_chats)
+    for table in MEMBER_TABLES:
+        chats.update(table)
+    return chats
+
+async def write_snapshot(path: str):
+    """Capture chat by chat, yielding between chats, then encode off the event loop"""
+    ensure_all_loaded()
+    captured_at = now_utc().timestamp()
+    meta = dump_meta()
+    meta["event_seq"] = str(current_event_seq())
+    chats = []
+    chat_seq = {}
+    epochs = {}
+    for chat_id in state_chats():
+        chats.append((chat_id, capture_chat(chat_id)))
+        chat_seq[chat_id] = current_event_seq()
+        if chat_id in chat_epochs:  # Taken with the counters, which a later roll would clear
+            epochs[chat_id] = dict(chat_epochs[chat_id])
+        await asyncio.sleep(0)
+    meta["chat_seq"] = json.dumps(chat_seq)
+    meta["chat_epochs"] = json.dumps(epochs)
+    started = perf_counter()
+    size = await asyncio.get_running_loop().run_in_executor(None, encode_snapshot, path, captured_at, meta, chats)
+    print(f"Snapshot written: {len(chats)} chats, {size} bytes in {(perf_counter() - started) * 1000:.0f} ms")
+
+def write_snapshot_sync(path: str):
+    ensure_all_loaded()
+    chats = [(chat_id, capture_chat(chat_id)) for chat_id in state_chats()]
+    meta = dump_meta()
+    meta["event_seq"] = str(current_event_seq())
+    meta["chat_seq"] = json.dumps({chat_id: current_event_seq() for chat_id, _ in chats})
+    encode_snapshot(path, now_utc().timestamp(), meta, chats)
+
+async def job_snapshot(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if isinstance(store, EventLogStore):
+            await compact_event_log(store)
+        else:
+            await write_snapshot(SNAPSHOT_PATH)
+    except Exception as e:
+        print(f"Snapshot failed: {e}")
+
+# ========= EVENT LOG =========
+# With STORAGE_BACKEND = "eventlog" every state change is appended to a
+# segmented, length-prefixed binary log instead of rewriting rows. Record
+# layout (little-endian):
+#   <II       payload length, crc32 of payload
+#   <BQdqqqqq kind, seq, timestamp, chat_id, user_id, a, b, c
+#   utf-8     optional text (content type, item id, achievement name, ...)
+# Startup replays the segments on top of the latest snapshot; each chat in
+# the snapshot remembers the last event seq it already contains. Compaction
+# rotates the log, writes a new snapshot and archives the folded segments so
+# history can still be replayed from scratch after a rules change.
+
+class Ev:
+    Post = 1          # a=points, text=content type
+    Xp = 2            # a=xp gained
+    Coins = 3         # a=coins awarded (after multipliers)
+    Purchase = 4      # text=item id
+    Reaction = 5      # user=author, a=reactor, b=message id, c=delta
+    Referral = 6      # user=referee, a=referrer
+    Achievement = 7   # text=achievement/badge name
+    Join = 8
+    Activity = 9      # a=message id credited to the user for reactions (0 if none)
+    Challenge = 10    # text=challenge id, a=progress, b=completed
+    Title = 11        # a=1 set (text=title) / 0 reset
+    Reset = 12        # chat-wide, text="daily"/"weekly", a=epoch (chat 0: epoch advanced)
+    Streak = 13       # a=new streak value
+    Warn = 14         # a=WARN_NEW_MEMBER / WARN_INACTIVE
+    Remove = 15       # a=WARN_NEW_MEMBER / WARN_INACTIVE
+    Milestone = 16    # user=referee, a=referrer
+    Challenges = 17   # chat 0, text=comma separated challenge ids
+    ReferralCode = 18 # text=code
+
+WARN_NEW_MEMBER = 1
+WARN_INACTIVE = 2
+
+EVENT_FRAME = struct.Struct("<II")
+EVENT_FIELDS = struct.Struct("<BQdqqqqq")
+
+def segment_path(directory: str, number: int) -> str:
+    return os.path.join(directory, f"segment-{number:08d}.log")
+
+def list_segments(directory: str) -> List[Tuple[int, str]]:
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith("segment-") and name.endswith(".log"):
+            segments.append((int(name[8:-4]), os.path.join(directory, name)))
+    return sorted(segments)
+
+def read_segment(path: str):
+    """Yield decoded events, stopping at a torn or corrupt tail"""
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + EVENT_FRAME.size <= len(data):
+        length, crc = EVENT_FRAME.unpack_from(data, pos)
+        start = pos + EVENT_FRAME.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc or length < EVENT_FIELDS.size:
+            print(f"Event log {path}: stopping at corrupt record (offset {pos})")
+            return
+        fields = EVENT_FIELDS.unpack_from(payload, 0)
+        yield fields + (payload[EVENT_FIELDS.size:].decode(),)
+        pos = start + length
+
+class EventLog:
+    """Appends events to the current segment; buffered on the loop, synced from a worker thread.
+
+    `lock` guards the in-memory buffer and is held only to append or swap
+    it, so the loop never waits for disk I/O; `io_lock` serializes writes,
+    fsyncs and rotations of the segment file.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        segments = list_segments(directory)
+        self.segment = segments[-1][0] + 1 if segments else 1
+        if segments and os.path.getsize(segments[-1][1]) == 0:
+            self.segment -= 1  # Reuse an empty tail segment
+        self.seq = 0
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self._file = open(segment_path(directory, self.segment), "ab")
+
+    def append(self, kind: int, chat_id: int, user_id: int, a: int, b: int, c: int, text: str):
+        self.seq += 1
+        payload = EVENT_FIELDS.pack(kind, self.seq, now_utc().timestamp(), chat_id, user_id, a, b, c) + text.encode()
+        frame = EVENT_FRAME.pack(len(payload), zlib.crc32(payload))
+        with self.lock:
+            self.buffer += frame
+            self.buffer += payload
+
+    def sync(self):
+        with self.io_lock:
+            self._write_locked()
+
+    def _write_locked(self):
+        """Write out the buffer; the caller holds io_lock"""
+        with self.lock:
+            data, self.buffer = self.buffer, bytearray()
+        if not data:
+            return
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def rotate(self) -> int:
+        """Start a new segment; returns the number of the last closed one"""
+        with self.io_lock:
+            self._write_locked()
+            self._file.close()
+            closed = self.segment
+            self.segment += 1
+            self._file = open(segment_path(self.directory, self.segment), "ab")
+        return closed
+
+    def rotate_if_large(self):
+        if self._file.tell() + len(self.buffer) >= EVENT_LOG_SEGMENT_BYTES:
+            self.rotate()
+
+    def close(self):
+        with self.io_lock:
+            self._write_locked()
+            self._file.close()
+
+event_log: Optional[EventLog] = None
+_replaying = False
+
+def current_event_seq() -> int:
+    return event_log.seq if event_log is not None else 0
+
+def record(kind: int, chat_id: int, user_id: int = 0, a: int = 0, b: int = 0, c: int = 0, text: str = ""):
+    """Append a state-change event (no-op unless the event log backend is active)"""
+    if event_log is not None and not _replaying:
+        event_log.append(kind, chat_id, user_id, a, b, c, text)
+
+def apply_event(kind: int, ts: float, chat_id: int, user_id: int, a: int, b: int, c: int, text: str,
+                points: Optional[Dict[str, int]] = None):
+    """Re-apply one logged event to the in-memory state.
+
+    points optionally maps content types to post values, so post counts can be
+    re-derived under new rules instead of using the logged value.
+    """
+    global current_weekly_challenges
+    when = _from_ts(ts)
+    if kind in (Ev.Post, Ev.Activity, Ev.Join):
+        known_chats.add(chat_id)
+    if kind == Ev.Post:
+        add = points.get(text, a) if points is not None else a
+        total_content_count[chat_id][user_id] += add
+        daily_content_count[chat_id][user_id] += add
+        weekly_content_count[chat_id][user_id] += add
+        count_rolling_post(chat_id, user_id, add, when)
+        update_streak(chat_id, user_id, when)
+        content_type_count[chat_id][user_id][text] += 1
+    elif kind == Ev.Xp:
+        xp_levels[chat_id][user_id] += a
+    elif kind == Ev.Coins:
+        user_coins[chat_id][user_id] += a
+    elif kind == Ev.Purchase:
+        apply_purchase(chat_id, user_id, text, when)
+    elif kind == Ev.Reaction:
+        apply_reaction(chat_id, b, user_id, a, c)
+    elif kind == Ev.Referral:
+        apply_referral(chat_id, user_id, a)
+    elif kind == Ev.Achievement:
+        achievements[chat_id][user_id].add(text)
+    elif kind == Ev.Join:
+        user_join_dates[chat_id][user_id] = when
+        new_member_deadline[chat_id][user_id] = when + NEW_MEMBER_POST_WINDOW
+    elif kind == Ev.Activity:
+        note_activity(chat_id, user_id, when)
+        if a:
+            message_authors[chat_id].add(a, user_id, when)
+    elif kind == Ev.Challenge:
+        weekly_challenge_progress[chat_id][user_id][text] = a
+        if b:
+            weekly_challenge_completed[chat_id][user_id].add(text)
+    elif kind == Ev.Title:
+        if a:
+            user_titles[chat_id][user_id] = text
+            if "Custom Title" in user_inventory[chat_id][user_id]:
+                user_inventory[chat_id][user_id].remove("Custom Title")
+        else:
+            user_titles[chat_id].pop(user_id, None)
+    elif kind == Ev.Reset:
+        if chat_id == 0:
+            period_epochs[text] = a
+            if text == "weekly":
+                period_boundaries["weekly"] = weekly_boundary(when).timestamp()
+        else:
+            (reset_daily if text == "daily" else reset_weekly)(chat_id)
+            chat_epochs.setdefault(chat_id, dict(period_epochs))[text] = a
+    elif kind == Ev.Streak:
+        user_streaks[chat_id][user_id] = a
+    elif kind == Ev.Warn:
+        (new_member_warned if a == WARN_NEW_MEMBER else warned_48h)[chat_id].add(user_id)
+    elif kind == Ev.Remove:
+        if a == WARN_NEW_MEMBER:
+            new_member_deadline[chat_id].pop(user_id, None)
+            new_member_warned[chat_id].discard(user_id)
+        else:
+            last_activity_utc[chat_id].pop(user_id, None)
+            warned_48h[chat_id].discard(user_id)
+    elif kind == Ev.Milestone:
+        referral_milestones_claimed[chat_id].add((a, user_id))
+        referral_stats[chat_id][a]["active_referrals"] += 1
+    elif kind == Ev.Challenges:
+        current_weekly_challenges = set(text.split(",")) & set(WEEKLY_CHALLENGES)
+    elif kind == Ev.ReferralCode:
+        user_referral_codes[chat_id][user_id] = text
+
+def replay_segments(segments: List[Tuple[int, str]], chat_seq: Dict[int, int], meta_seq: int,
+                    points: Optional[Dict[str, int]] = None) -> int:
+    """Replay events newer than what the snapshot already holds; returns the last seq seen.
+
+    Seqs only grow, so a record at or below the newest one read is a
+    duplicate and is skipped.
+    """
+    global _replaying
+    last_seq = meta_seq
+    newest = 0
+    applied = 0
+    _replaying = True
+    try:
+        for _, path in segments:
+            for kind, seq, ts, chat_id, user_id, a, b, c, text in read_segment(path):
+                if seq <= newest:
+                    continue
+                newest = seq
+                last_seq = max(last_seq, seq)
+                if seq <= (chat_seq.get(chat_id, 0) if chat_id else meta_seq):
+                    continue
+                event = partial(apply_event, kind, ts, chat_id, user_id, a, b, c, text, points)
+                if not defer_until_hydrated(chat_id, event):
+                    event()
+                applied += 1
+    finally:
+        _replaying = False
+    print(f"Replayed {applied} events from {len(segments)} segments")
+    return last_seq
+
+class EventLogStore(MemoryStore):
+    """Durability via snapshot + append-only event log; rows are never rewritten"""
+    name = "eventlog"
+
+    def __init__(self, directory: str):
+        global event_log
+        self.directory = directory
+        self.archive = os.path.join(directory, "archive")
+        self.segments = list_segments(directory)
+        event_log = self.log = EventLog(directory)
+
+    def load(self, since: Optional[float] = None):
+        chat_seq = {int(k): v for k, v in json.loads(snapshot_meta.get("chat_seq", "{}")).items()}
+        self.log.seq = replay_segments(self.segments, chat_seq, int(snapshot_meta.get("event_seq", 0)))
+
+    def write(self, members: List[tuple], meta: Dict[str, str]):
+        self.log.sync()
+
+    def compact(self, closed_segment: int):
+        """Archive (or drop) segments now folded into the latest snapshot"""
+        for number, path in list_segments(self.directory):
+            if number > closed_segment:
+                continue
+            if EVENT_LOG_ARCHIVE:
+                os.makedirs(self.archive, exist_ok=True)
+                os.replace(path, os.path.join(self.archive, os.path.basename(path)))
+            else:
+                os.remove(path)
+
+    def close(self):
+        self.log.close()
+
+async def compact_event_log(store: EventLogStore):
+    """Fold all closed segments into a fresh snapshot"""
+    closed = await asyncio.get_running_loop().run_in_executor(None, store.log.rotate)
+    await write_snapshot(SNAPSHOT_PATH)
+    await asyncio.get_running_loop().run_in_executor(None, store.compact, closed)
+    print(f"Event log compacted through segment {closed}")
+
+def rebuild_from_history(directory: str, points: Optional[Dict[str, int]] = None):
+    """Rebuild state from scratch by replaying archived and live segments in order"""
+    segments = list_segments(os.path.join(directory, "archive")) + list_segments(directory)
+    replay_segments(segments, {}, 0, points)
+
+# ========= UPDATE PROCESSING =========
+def update_key(update: object) -> Tuple[int, int]:
+    """(chat_id, user_id) an update is ordered by; 0 where it has neither"""
+    if not isinstance(update, Update):
+        return (0, 0)
+    chat, user = update.effective_chat, update.effective_user
+    return (chat.id if chat else 0, user.id if user else 0)
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but strictly in order per (chat, user).
+
+    The first update for a key runs its handlers; updates for the same key
+    that arrive meanwhile are queued behind it and run by the same task, so
+    a user's counters, balance checks and purchases never interleave with
+    their own next update. Queued updates return their slot right away, so
+    one flooding user holds at most one of the max_concurrent_updates slots
+    and a slow handler in one chat no longer stalls the others.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.backlog: Dict[Tuple[int, int], deque] = {}
+        self.processed = 0
+        self.queued = 0
+        self.max_backlog = 0
+        self.max_active = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        print(f"Update processing: {self.summary()}")
+
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        key = update_key(update)
+        backlog = self.backlog.get(key)
+        if backlog is not None:
+            backlog.append(coroutine)
+            self.queued += 1
+            self.max_backlog = max(self.max_backlog, len(backlog))
+            return
+        backlog = self.backlog[key] = deque()
+        self.max_active = max(self.max_active, len(self.backlog))
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception as ex:
+                    print(f"Update processing failed for {key}: {ex}")
+                self.processed += 1
+                if not backlog:
+                    break
+                coroutine = backlog.popleft()
+        finally:
+            del self.backlog[key]
+            for pending in backlog:  # Only left over if this task was cancelled
+                pending.close()
+
+    def summary(self) -> str:
+        return (f"processed={self.processed} queued_behind_same_key={self.queued} "
+                f"max_backlog={self.max_backlog} max_active_keys={self.max_active} "
+                f"limit={self.max_concurrent_updates}")
+
+# ========= OUTBOUND =========
+# Every message the bot sends goes through one scheduler: a global token
+# bucket plus one bucket per chat, a priority queue per chat (command replies
+# before announcements) and a bounded total queue. Flood-wait (429) and
+# network errors pause the affected bucket and requeue the message instead
+# of sleeping inside the handler that sent it.
+
+PRIORITY_REPLY = 0
+PRIORITY_ANNOUNCE = 1
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+class OutboundJob:
+    __slots__ = ("priority", "seq", "chat_id", "send", "future", "attempts", "queued_at")
+
+    def __init__(self, priority: int, seq: int, chat_id: int, send: Callable[[], Awaitable], future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.send = send
+        self.future = future
+        self.attempts = 0
+        self.queued_at = monotonic()
+
+    def __lt__(self, other: "OutboundJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundScheduler:
+    """Rate-limited, prioritized dispatcher for all outgoing messages.
+
+    Each chat has its own job heap and at most one send in flight, so
+    messages to a chat keep their order while different chats proceed in
+    parallel. `ready` holds (job, chat) heads of idle chats; stale entries are
+    skipped lazily when popped.
+    """
+
+    def __init__(self, global_rate: float, chat_rate_per_min: float, chat_burst: float, max_queued: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate_per_min / 60
+        self.chat_burst = chat_burst
+        self.max_queued = max_queued
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.queues: Dict[int, List[OutboundJob]] = {}
+        self.ready: List[OutboundJob] = []
+        self.busy: Set[int] = set()
+        self.queued = 0
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._not_full: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.blocked = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _start(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._not_full = asyncio.Event()
+            self._not_full.set()
+            self._worker = asyncio.create_task(self._run())
+
+    def bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def submit(self, chat_id: int, send: Callable[[], Awaitable], priority: int = PRIORITY_ANNOUNCE):
+        """Queue a send and wait for its result (backpressure while the queue is full)"""
+        self._start()
+        while self.queued >= self.max_queued:
+            self.blocked += 1
+            self._not_full.clear()
+            await self._not_full.wait()
+        self._seq += 1
+        job = OutboundJob(priority, self._seq, chat_id, send, asyncio.get_running_loop().create_future())
+        self._enqueue(job)
+        return await job.future
+
+    def _enqueue(self, job: OutboundJob):
+        queue = self.queues.setdefault(job.chat_id, [])
+        heapq.heappush(queue, job)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.queued)
+        if job.chat_id not in self.busy and queue[0] is job:
+            heapq.heappush(self.ready, job)
+        self._wakeup.set()
+
+    def _pick(self, now: float) -> Tuple[Optional[OutboundJob], float]:
+        """Best job whose chat has a token, or (None, seconds to wait)"""
+        deferred = []
+        chosen, wait = None, 60.0
+        while self.ready:
+            job = heapq.heappop(self.ready)
+            queue = self.queues.get(job.chat_id)
+            if job.chat_id in self.busy or not queue or queue[0] is not job:
+                continue  # stale head
+            delay = self.bucket(job.chat_id).delay(now)
+            if delay == 0:
+                chosen = job
+                break
+            deferred.append(job)
+            wait = min(wait, delay)
+        for job in deferred:
+            heapq.heappush(self.ready, job)
+        return chosen, wait
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = monotonic()
+            delay = self.global_bucket.delay(now)
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            job, wait = self._pick(now)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait if self.ready else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.global_bucket.take()
+            self.bucket(job.chat_id).take()
+            heapq.heappop(self.queues[job.chat_id])
+            self.queued -= 1
+            if self.queued < self.max_queued:
+                self._not_full.set()
+            self.busy.add(job.chat_id)
+            task = asyncio.create_task(self._deliver(job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, job: OutboundJob):
+        job.attempts += 1
+        retry_in = None
+        try:
+            result = await job.send()
+        except RetryAfter as e:
+            self.rate_limited += 1
+            retry_in, error = float(e.retry_after) + 0.5, e
+        except (TimedOut, NetworkError) as e:
+            retry_in, error = 1.5 * 2 ** (job.attempts - 1), e
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+        if retry_in is not None:
+            if job.attempts < OUTBOUND_MAX_ATTEMPTS:
+                self.retries += 1
+                self.bucket(job.chat_id).pause(retry_in)
+                self._enqueue(job)
+            else:
+                self._finish(job, error=error)
+        self.busy.discard(job.chat_id)
+        queue = self.queues.get(job.chat_id)
+        if queue:
+            heapq.heappush(self.ready, queue[0])
+        elif queue is not None:
+            del self.queues[job.chat_id]
+        self._wakeup.set()
+
+    def _finish(self, job: OutboundJob, result=None, error: Optional[BaseException] = None):
+        waited = monotonic() - job.queued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        if job.future.done():
+            return
+        if error is not None:
+            self.failed += 1
+            job.future.set_exception(error)
+        else:
+            self.sent += 1
+            job.future.set_result(result)
+
+    async def drain(self, timeout: float):
+        """Give queued messages a chance to go out before shutdown"""
+        deadline = monotonic() + timeout
+        while (self.queued or self._inflight) and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._worker is not None:
+            self._worker.cancel()
+
+    def summary(self) -> str:
+        done = self.sent + self.failed
+        avg_wait = self.wait_total / done * 1000 if done else 0
+        return (f"queued={self.queued} max_depth={self.max_depth} sent={self.sent} failed={self.failed} "
+                f"retries={self.retries} 429s={self.rate_limited} blocked_submits={self.blocked} "
+                f"wait avg={avg_wait:.0f}ms max={self.wait_max * 1000:.0f}ms")
+
+outbound = OutboundScheduler(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_QUEUE_MAX)
+
 # ========= UTIL =========
 def now_utc() -> datetime:
     return datetime.now(UTC)
@@ -407,42 +2360,494 @@ def fmt_span(td: timedelta) -> str:
     if minutes > 0: return f"{minutes}m"
     return f"{seconds}s"
 
-async def mention(app: Application, chat_id: int, user_id: int) -> str:
+def display_name(user) -> str:
+    return user.first_name or user.username or "User"
+
+class NameCache:
+    """LRU of (chat_id, user_id) -> display name with TTLs.
+
+    Filled passively from users seen in updates and by mention() lookups;
+    failed lookups are cached as None for a shorter time.
+    """
+
+    def __init__(self, max_entries: int, ttl: timedelta, negative_ttl: timedelta):
+        self.max_entries = max_entries
+        self.ttl = ttl.total_seconds()
+        self.negative_ttl = negative_ttl.total_seconds()
+        self.entries: "OrderedDict[Tuple[int, int], Tuple[Optional[str], float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, user_id: int) -> Tuple[bool, Optional[str]]:
+        """(found, name); name is None for a cached failure"""
+        key = (chat_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < monotonic():
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, chat_id: int, user_id: int, name: Optional[str]):
+        key = (chat_id, user_id)
+        self.entries[key] = (name, monotonic() + (self.ttl if name is not None else self.negative_ttl))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def note(self, chat_id: int, user):
+        """Passively record a user seen in an update"""
+        if user is not None and not user.is_bot:
+            self.put(chat_id, user.id, display_name(user))
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        return f"{len(self.entries)} names, {self.hits}/{lookups} hits ({rate:.0f}%)"
+
+name_cache = NameCache(NAME_CACHE_MAX_ENTRIES, NAME_CACHE_TTL, NAME_CACHE_NEGATIVE_TTL)
+
+def format_mention(user_id: int, name: Optional[str]) -> str:
+    return f'<a href="tg://user?id={user_id}">{escape_html(name or "User")}</a>'
+
+async def fetch_name(app: Application, chat_id: int, user_id: int) -> Optional[str]:
+    """Look a name up via the API and cache the result (None on failure)"""
     try:
         cm = await app.bot.get_chat_member(chat_id, user_id)
-        name = cm.user.first_name or cm.user.username or "User"
-        return f'<a href="tg://user?id={user_id}">{escape_html(name)}</a>'
+        name = display_name(cm.user)
     except Exception:
-        return f'<a href="tg://user?id={user_id}">User</a>'
+        name = None
+    name_cache.put(chat_id, user_id, name)
+    return name
+
+async def mention(app: Application, chat_id: int, user_id: int) -> str:
+    found, name = name_cache.get(chat_id, user_id)
+    if not found:
+        name = await fetch_name(app, chat_id, user_id)
+    return format_mention(user_id, name)
+
+async def mentions(app: Application, chat_id: int, user_ids: Iterable[int]) -> Dict[int, str]:
+    """Mentions for many users; uncached names are fetched concurrently.
+
+    At most NAME_RESOLVE_CONCURRENCY lookups run at once and the whole batch
+    waits at most NAME_RESOLVE_DEADLINE; anything still pending is rendered
+    as "User" (and not cached, so a later report can retry it).
+    """
+    names: Dict[int, Optional[str]] = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        found, names[user_id] = name_cache.get(chat_id, user_id)
+        if not found:
+            missing.append(user_id)
+    if missing:
+        semaphore = asyncio.Semaphore(NAME_RESOLVE_CONCURRENCY)
+
+        async def resolve(user_id: int):
+            async with semaphore:
+                names[user_id] = await fetch_name(app, chat_id, user_id)
+
+        tasks = [asyncio.create_task(resolve(user_id)) for user_id in missing]
+        _, pending = await asyncio.wait(tasks, timeout=NAME_RESOLVE_DEADLINE.total_seconds())
+        for task in pending:
+            task.cancel()
+    return {user_id: format_mention(user_id, name) for user_id, name in names.items()}
+
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+class AdminRoster:
+    """Per-chat set of administrator/owner ids.
+
+    Fetched with one get_chat_administrators call per chat and ADMIN_ROSTER_TTL,
+    and kept current in between by chat_member updates, so enforcement can
+    exempt admins without a get_chat_member call per member.
+    """
+
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl.total_seconds()
+        self.rosters: Dict[int, Tuple[Set[int], float]] = {}
+        self.fetches = 0
+
+    async def admins(self, bot, chat_id: int) -> Set[int]:
+        roster = self.rosters.get(chat_id)
+        if roster is None or roster[1] < monotonic():
+            members = await bot.get_chat_administrators(chat_id)
+            self.fetches += 1
+            for cm in members:
+                name_cache.note(chat_id, cm.user)
+            roster = ({cm.user.id for cm in members}, monotonic() + self.ttl)
+            self.rosters[chat_id] = roster
+        return roster[0]
+
+    async def is_admin(self, bot, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.admins(bot, chat_id)
+
+    def apply(self, chat_id: int, user_id: int, status: str):
+        """Apply a chat_member update to an already fetched roster"""
+        roster = self.rosters.get(chat_id)
+        if roster is None:
+            return
+        if status in ADMIN_STATUSES:
+            roster[0].add(user_id)
+        else:
+            roster[0].discard(user_id)
+
+    def summary(self) -> str:
+        return f"{len(self.rosters)} chats, {self.fetches} fetches"
+
+admin_roster = AdminRoster(ADMIN_ROSTER_TTL)
 
 async def reply_in_same_topic(update: Update, text: str, parse_mode=ParseMode.HTML):
     msg = update.effective_message
     thread_id = getattr(msg, "message_thread_id", None)
     if thread_id:
-        await msg.chat.send_message(text=text, parse_mode=parse_mode, message_thread_id=thread_id)
+        send = partial(msg.chat.send_message, text=text, parse_mode=parse_mode, message_thread_id=thread_id)
     else:
-        await msg.chat.send_message(text=text, parse_mode=parse_mode)
+        send = partial(msg.chat.send_message, text=text, parse_mode=parse_mode)
+    await outbound.submit(msg.chat.id, send, PRIORITY_REPLY)
 
-async def safe_notify(context: ContextTypes.DEFAULT_TYPE, chat_id: int, html: str):
-    max_attempts = 5
-    delay = 1.5
-    for attempt in range(1, max_attempts + 1):
-        try:
-            await context.bot.send_message(chat_id, html, parse_mode=ParseMode.HTML)
-            return
-        except RetryAfter as e:
-            await asyncio.sleep(e.retry_after + 0.5)
-        except (TimedOut, NetworkError):
-            await asyncio.sleep(delay)
-            delay *= 2
-        except Forbidden as e:
-            print(f"Notify forbidden ({chat_id}): {e}")
+_USER_TAG = re.compile("\x00(-?\\d+)\x00")
+_HTML_TOKEN = re.compile(r"<[^>]*>|&#?\w+;|[^<&\n]+|.", re.S)  # Tag, entity, text run or single char
+_HTML_TAG = re.compile(r"<(/?)([A-Za-z][\w-]*)")
+
+def _closing_tags(opened: List[str]) -> str:
+    return "".join(f"</{_HTML_TAG.match(tag).group(2)}>" for tag in reversed(opened))
+
+def _after_tag(opened: List[str], token: str) -> List[str]:
+    """The open tags once `token` has been emitted"""
+    match = _HTML_TAG.match(token)
+    if not match or token.endswith("/>"):
+        return opened
+    if not match.group(1):
+        return opened + [token]
+    for i in range(len(opened) - 1, -1, -1):
+        if _HTML_TAG.match(opened[i]).group(2) == match.group(2):
+            return opened[:i] + opened[i + 1:]
+    return opened
+
+def user_tag(user_id: int) -> str:
+    """Placeholder for a mention, resolved in bulk when the announcement is sent"""
+    return f"\x00{user_id}\x00"
+
+SQL_OUTBOX_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS outbox ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, chat_id INTEGER NOT NULL, "
+    "html TEXT NOT NULL, created_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+    "next_attempt_at REAL NOT NULL DEFAULT 0, status INTEGER NOT NULL DEFAULT 0, "
+    "sent_at REAL, last_error TEXT, parts_sent INTEGER NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, next_attempt_at)",
+)
+OUTBOX_PENDING = 0
+OUTBOX_SENT = 1
+OUTBOX_DEAD = 2
+
+class Outbox:
+    """Durable record of every announcement until it is delivered.
+
+    Rows are keyed by an idempotency key, so re-announcing the same event
+    (a replayed update, a restart mid-delivery) never queues it twice. Rows
+    stay pending until a send succeeds; a crash between the send and
+    mark_sent re-sends once after restart (at-least-once). An announcement
+    sent in several parts records how many went out, so a retry resumes
+    after them. Called from the default executor, never on the event loop
+    (except at startup).
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path or ":memory:", isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SQL_OUTBOX_SCHEMA:
+            self.conn.execute(statement)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")}
+        if "parts_sent" not in columns:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN parts_sent INTEGER NOT NULL DEFAULT 0")
+
+    def put(self, chat_id: int, items: List[Tuple[str, str]]) -> List[Optional[int]]:
+        """Record (key, html) announcements; returns each row id, or None where the key was already used"""
+        created_at = now_utc().timestamp()
+        # The caller sends right away; due() only picks the row up if that attempt is lost
+        retry_at = created_at + OUTBOX_RETRY_INTERVAL.total_seconds()
+        row_ids = []
+        with self.lock:
+            for key, html in items:
+                cur = self.conn.execute(
+                    "INSERT OR IGNORE INTO outbox (key, chat_id, html, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, chat_id, html, created_at, retry_at),
+                )
+                row_ids.append(cur.lastrowid if cur.rowcount else None)
+        return row_ids
+
+    def mark_sent(self, ids: List[int]):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE outbox SET status = ?, sent_at = ?, attempts = attempts + 1 WHERE id = ?",
+                [(OUTBOX_SENT, now_utc().timestamp(), row_id) for row_id in ids],
+            )
+
+    def mark_failed(self, ids: List[int], error: str, permanent: bool = False, parts_sent: int = 0):
+        """Schedule a retry with backoff, or dead-letter after OUTBOX_MAX_ATTEMPTS.
+
+        `parts_sent` is how many parts of a multi-part announcement (always a
+        single row) were delivered; the retry skips them.
+        """
+        now = now_utc().timestamp()
+        with self.lock:
+            for row_id in ids:
+                attempts = self.conn.execute("SELECT attempts FROM outbox WHERE id = ?", (row_id,)).fetchone()[0] + 1
+                dead = permanent or attempts >= OUTBOX_MAX_ATTEMPTS
+                self.conn.execute(
+                    "UPDATE outbox SET attempts = ?, last_error = ?, status = ?, next_attempt_at = ?, parts_sent = ? "
+                    "WHERE id = ?",
+                    (attempts, error, OUTBOX_DEAD if dead else OUTBOX_PENDING,
+                     now + OUTBOX_RETRY_INTERVAL.total_seconds() * 2 ** (attempts - 1), parts_sent, row_id),
+                )
+
+    def due(self) -> List[Tuple[int, int, str, int]]:
+        """Pending (id, chat_id, html, parts_sent) whose next attempt is due, oldest first"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, chat_id, html, parts_sent FROM outbox WHERE status = ? AND next_attempt_at <= ? ORDER BY id",
+                (OUTBOX_PENDING, now_utc().timestamp()),
+            ).fetchall()
+
+    def prune(self):
+        """Forget delivered/dead rows (and their keys) after OUTBOX_RETENTION"""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM outbox WHERE status != ? AND created_at < ?",
+                (OUTBOX_PENDING, (now_utc() - OUTBOX_RETENTION).timestamp()),
+            )
+
+    def metrics(self) -> Dict[str, float]:
+        with self.lock:
+            depth, oldest = self.conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE status = ?", (OUTBOX_PENDING,)
+            ).fetchone()
+            dead = self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (OUTBOX_DEAD,)).fetchone()[0]
+        return {
+            "depth": depth,
+            "oldest_age": now_utc().timestamp() - oldest if oldest else 0.0,
+            "dead": dead,
+        }
+
+    def summary(self) -> str:
+        m = self.metrics()
+        return f"depth={m['depth']} oldest={fmt_span(timedelta(seconds=m['oldest_age']))} dead={m['dead']}"
+
+    def close(self):
+        self.conn.close()
+
+outbox = Outbox("")  # Replaced by the file-backed outbox in main()
+
+def announcement_key(chat_id: int, html: str) -> str:
+    """Default idempotency key: the same text in the same chat within ANNOUNCE_DEDUP_TTL"""
+    bucket = int(now_utc().timestamp() // ANNOUNCE_DEDUP_TTL.total_seconds())
+    return f"{chat_id}:{bucket}:{hashlib.sha1(html.encode()).hexdigest()[:16]}"
+
+class Announcer:
+    """Coalesces announcements per chat and delivers them in the background.
+
+    The first announcement for a chat opens a window; everything queued for
+    that chat before it closes (one update's level-up, challenge and badge
+    notices, or several users' in a busy chat) is sent as one message, split
+    only when it would exceed ANNOUNCE_MAX_CHARS; a single announcement over
+    the limit is itself sent in several parts. Handlers only append the
+    announcement to a list: the background delivery records it in the outbox
+    (off the event loop) before sending, user_tag() placeholders are resolved
+    with one bulk mentions() call at send time, and retries happen in the
+    outbound scheduler and then via the outbox.
+    """
+
+    def __init__(self, window: timedelta, max_chars: int):
+        self.window = window.total_seconds()
+        self.max_chars = max_chars
+        self.pending: Dict[int, List[Tuple[Optional[int], str, str]]] = {}  # (row id, key, html)
+        self.timers: Dict[int, asyncio.TimerHandle] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.queued_ids: Set[int] = set()  # Outbox rows buffered or in flight
+        self.queued_keys: Set[str] = set()  # Keys buffered but not yet in the outbox
+        self.parts_sent: Dict[int, int] = {}  # Row id -> parts an earlier attempt delivered
+        self.app: Optional[Application] = None
+        self.announcements = 0
+        self.duplicates = 0
+        self.messages = 0
+
+    def add(self, app: Application, chat_id: int, html: str, key: Optional[str] = None):
+        key = key or announcement_key(chat_id, html)
+        if key in self.queued_keys:
+            self.duplicates += 1
             return
+        self.queued_keys.add(key)
+        self.enqueue(app, chat_id, None, key, html)
+
+    def enqueue(self, app: Application, chat_id: int, row_id: Optional[int], key: str, html: str):
+        """Buffer an announcement; row_id is None until it is recorded in the outbox"""
+        self.app = app
+        if row_id is not None:
+            self.queued_ids.add(row_id)
+        self.pending.setdefault(chat_id, []).append((row_id, key, html))
+        if chat_id not in self.timers:
+            self.timers[chat_id] = asyncio.get_running_loop().call_later(self.window, self._flush, chat_id)
+
+    def batches(self, items: List[Tuple[int, str]]) -> List[Tuple[List[int], List[str]]]:
+        """(row ids, messages) per batch; only an oversized announcement has several messages"""
+        batches, ids, current, size = [], [], [], 0
+        for row_id, html in items:
+            if current and (size + len(html) + 2 > self.max_chars or len(html) > self.max_chars):
+                batches.append((ids, ["\n\n".join(current)]))
+                ids, current, size = [], [], 0
+            if len(html) > self.max_chars:
+                batches.append(([row_id], self.split(html)))
+                continue
+            ids.append(row_id)
+            current.append(html)
+            size += len(html) + 2
+        if current:
+            batches.append((ids, ["\n\n".join(current)]))
+        return batches
+
+    def split(self, html: str) -> List[str]:
+        """Cut an oversized announcement at line breaks, or mid-line if one line is too long.
+
+        Cuts never fall inside a tag or an entity; tags open at a cut are
+        closed at the end of the part and reopened at the start of the next.
+        """
+        parts, current, opened = [], "", []
+        start = 0  # Length of the reopened tags that begin `current`
+        newline = None  # (offset, open tags) of the last line break in `current`
+
+        def cut(at: int, skip: int, tags: List[str]):
+            nonlocal current, start, newline
+            parts.append(current[:at] + _closing_tags(tags))
+            reopen = "".join(tags)
+            current, start, newline = reopen + current[at + skip:], len(reopen), None
+
+        for token in _HTML_TOKEN.findall(html):
+            while True:
+                after = _after_tag(opened, token) if token[0] == "<" else opened
+                if len(current) + len(token) + len(_closing_tags(after)) <= self.max_chars:
+                    current += token
+                    opened = after
+                    if token == "\n":
+                        newline = (len(current) - 1, opened)
+                    break
+                if newline:
+                    cut(newline[0], 1, newline[1])
+                    continue
+                room = self.max_chars - len(current) - len(_closing_tags(opened))
+                if token[0] not in "<&\n" and room > 0:
+                    current += token[:room]
+                    token = token[room:]
+                    cut(len(current), 0, opened)
+                    continue
+                if len(current) > start:
+                    cut(len(current), 0, opened)
+                    continue
+                current += token  # A single tag longer than the limit; nothing to cut
+                opened = after
+                break
+        if len(current) > start:
+            parts.append(current)
+        return parts
+
+    def _flush(self, chat_id: int):
+        self.timers.pop(chat_id, None)
+        items = self.pending.pop(chat_id, [])
+        if items:
+            task = asyncio.create_task(self._deliver(chat_id, items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _record(self, chat_id: int, items: List[Tuple[Optional[int], str, str]]) -> List[Tuple[int, str]]:
+        """Put new announcements in the outbox; returns (row id, html) of those to send"""
+        new = [(key, html) for row_id, key, html in items if row_id is None]
+        if not new:
+            return [(row_id, html) for row_id, _, html in items]
+        try:
+            row_ids = iter(await asyncio.get_running_loop().run_in_executor(None, outbox.put, chat_id, new))
         except Exception as ex:
-            print(f"Notify fail ({chat_id}) attempt {attempt}: {ex}")
-            await asyncio.sleep(delay)
-            delay *= 2
-    print(f"Notify ultimately failed after {max_attempts} attempts: chat {chat_id}")
+            print(f"Outbox write failed: chat {chat_id}: {ex}")
+            return [(row_id, html) for row_id, _, html in items if row_id is not None]
+        finally:
+            self.queued_keys.difference_update(key for key, _ in new)
+        recorded = []
+        for row_id, key, html in items:
+            if row_id is None:
+                row_id = next(row_ids)
+                if row_id is None:
+                    self.duplicates += 1
+                    continue
+                self.announcements += 1
+                self.queued_ids.add(row_id)
+            recorded.append((row_id, html))
+        return recorded
+
+    async def _deliver(self, chat_id: int, items: List[Tuple[Optional[int], str, str]]):
+        loop = asyncio.get_running_loop()
+        items = await self._record(chat_id, items)
+        user_ids = {int(uid) for _, html in items for uid in _USER_TAG.findall(html)}
+        names = await mentions(self.app, chat_id, user_ids) if user_ids else {}
+        resolve = lambda m: names.get(int(m.group(1)), "User")
+        for ids, messages in self.batches([(row_id, _USER_TAG.sub(resolve, html)) for row_id, html in items]):
+            done = [self.parts_sent.pop(row_id, 0) for row_id in ids]
+            sent = done[0] if len(messages) > 1 else 0
+            try:
+                for html in messages[sent:]:
+                    self.messages += 1
+                    send = partial(self.app.bot.send_message, chat_id, html, parse_mode=ParseMode.HTML)
+                    await outbound.submit(chat_id, send, PRIORITY_ANNOUNCE)
+                    sent += 1
+            except Exception as ex:
+                print(f"Notify failed: chat {chat_id}: {ex}")
+                mark = partial(outbox.mark_failed, ids, repr(ex), permanent=isinstance(ex, Forbidden),
+                               parts_sent=sent if len(messages) > 1 else 0)
+            else:
+                mark = partial(outbox.mark_sent, ids)
+            try:
+                await loop.run_in_executor(None, mark)
+            finally:
+                self.queued_ids.difference_update(ids)
+
+    async def resume(self, app: Application):
+        """Re-queue outbox rows that are due (after a restart or a failed attempt)"""
+        for row_id, chat_id, html, parts_sent in await asyncio.get_running_loop().run_in_executor(None, outbox.due):
+            if row_id not in self.queued_ids:
+                if parts_sent:
+                    self.parts_sent[row_id] = parts_sent
+                self.enqueue(app, chat_id, row_id, "", html)
+
+    async def flush_pending(self, timeout: float):
+        """Send everything now instead of waiting for the windows to close"""
+        for chat_id, timer in list(self.timers.items()):
+            timer.cancel()
+            self._flush(chat_id)
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+
+    def summary(self) -> str:
+        return (f"{self.announcements} announcements in {self.messages} messages, "
+                f"{self.duplicates} duplicates dropped")
+
+announcer = Announcer(ANNOUNCE_BATCH_WINDOW, ANNOUNCE_MAX_CHARS)
+
+async def safe_notify(context: ContextTypes.DEFAULT_TYPE, chat_id: int, html: str, key: Optional[str] = None):
+    """Hand an announcement to durable background delivery; returns immediately.
+
+    Use user_tag(user_id) instead of mention() in `html` so names are looked
+    up off the handler path. `key` identifies the event being announced
+    (e.g. "level:<chat>:<user>:<level>") so it is never posted twice.
+    """
+    announcer.add(context.application, chat_id, html, key)
+
+async def job_outbox(context: ContextTypes.DEFAULT_TYPE):
+    loop = asyncio.get_running_loop()
+    await announcer.resume(context.application)
+    await loop.run_in_executor(None, outbox.prune)
+    metrics = await loop.run_in_executor(None, outbox.metrics)
+    if metrics["depth"] or metrics["dead"]:
+        print(f"Outbox: {await loop.run_in_executor(None, outbox.summary)}")
 
 def content_delta(message) -> int:
     if message.photo:
@@ -472,11 +2877,196 @@ def award_coins(chat_id: int, user_id: int, amount: int, reason: str = "", rewar
     multiplier = get_multiplier(chat_id, user_id, reward_type)
     final_amount = int(amount * multiplier)
     user_coins[chat_id][user_id] += final_amount
+    touch(chat_id, user_id)
+    record(Ev.Coins, chat_id, user_id, final_amount)
     return final_amount
 
-def update_streak(chat_id: int, user_id: int):
-    today = now_utc().date()
+def apply_purchase(chat_id: int, user_id: int, item_id: str, when: datetime):
+    """Deduct an item's price and grant its effect"""
+    item = SHOP_ITEMS[item_id]
+    user_coins[chat_id][user_id] -= item["price"]
+    if item["type"] == "boost":
+        active_boosts[chat_id][user_id][item_id] = when + item["duration"]
+    elif item["type"] == "protection":
+        active_boosts[chat_id][user_id]["streak_freeze"] = when + item["duration"]  # Changed from "streak_protection"
+    elif item["type"] in ("title", "cosmetic"):
+        user_inventory[chat_id][user_id].append(item["name"])
+    touch(chat_id, user_id)
+
+def apply_reaction(chat_id: int, message_id: int, author_id: int, reactor_id: int, delta: int):
+    """Reaction bookkeeping shared by the live handler and event replay"""
+    weekly_reaction_totals[chat_id][author_id] += delta
+    touch(chat_id, author_id)
+    
+    # Track individual reaction counts for achievements
+    posts = post_reactions[chat_id]
+    post = posts.get(message_id)
+    if post is None:
+        if delta < 0:
+            return
+        post = posts[message_id] = PostReactions()
+        if len(posts) > 2 * MESSAGE_AUTHOR_HORIZON:
+            evict_post_reactions(chat_id)
+    had_reacted = reactor_id in post.reactors
+    post.add(reactor_id, delta)
+    # Count posts the reactor currently reacts to; evicted posts keep counting
+    now_reacted = reactor_id in post.reactors
+    if now_reacted != had_reacted:
+        reactions_given[chat_id][reactor_id] += 1 if now_reacted else -1
+        touch(chat_id, reactor_id)
+    # Track for weekly most loved posts
+    weekly_most_loved[chat_id].update(message_id, author_id, post.total)
+
+def apply_referral(chat_id: int, referee_id: int, referrer_id: int):
+    referral_stats[chat_id][referrer_id]["total_referrals"] += 1
+    weekly_referral_count[chat_id][referrer_id] += 1
+    referral_relationships[chat_id][referee_id] = referrer_id
+    touch(chat_id, referrer_id)
+    touch(chat_id, referee_id)
+
+def add_achievement(chat_id: int, user_id: int, name: str):
+    achievements[chat_id][user_id].add(name)
+    touch(chat_id, user_id)
+    record(Ev.Achievement, chat_id, user_id, text=name)
+
+def note_activity(chat_id: int, user_id: int, when: datetime):
+    """Any message counts as activity and clears pending join/inactivity warnings"""
+    last_activity_utc[chat_id][user_id] = when
+    if user_id in new_member_deadline[chat_id]:
+        new_member_deadline[chat_id].pop(user_id, None)
+        new_member_warned[chat_id].discard(user_id)
+    warned_48h[chat_id].discard(user_id)
+    deadlines.schedule(WARN_INACTIVE, chat_id, user_id, when + INACTIVITY_WARN_AT)
+    touch(chat_id, user_id)
+
+def reset_daily(chat_id: int):
+    daily_content_count[chat_id].clear()
+
+def reset_weekly(chat_id: int):
+    weekly_content_count[chat_id].clear()
+    weekly_reaction_totals[chat_id].clear()
+    weekly_most_loved[chat_id].clear()
+    weekly_challenge_progress[chat_id].clear()
+    weekly_challenge_completed[chat_id].clear()
+    weekly_referral_count[chat_id].clear()  # Clear weekly referral counts
+
+def count_rolling_post(chat_id: int, user_id: int, add: int, when: datetime):
+    counter = rolling_posts[chat_id].get(user_id)
+    if counter is None:
+        counter = rolling_posts[chat_id][user_id] = RollingCounter()
+    counter.add(bucket_of(when), add)
+    cached = rolling_ranks.get(chat_id)
+    if cached is not None:
+        bucket, day, week = cached
+        if counter.bucket > bucket:  # A new bucket began: rebuilt on the next read
+            del rolling_ranks[chat_id]
+            return
+        for scores, count in zip((day, week), counter.counts(bucket)):
+            if count:
+                scores[user_id] = count
+            else:
+                scores.pop(user_id, None)
+
+def rolling_scores(chat_id: int) -> Tuple[RankedScores, RankedScores]:
+    """Ranked posts per user over the last DAILY_WINDOW and WEEKLY_WINDOW.
+
+    Rebuilt from the counters once per ROLLING_BUCKET; count_rolling_post
+    keeps it current in between, so a read is O(log n) per ranked user.
+    """
+    bucket = bucket_of(now_utc())
+    cached = rolling_ranks.get(chat_id)
+    if cached is None or cached[0] != bucket:
+        day, week = RankedScores(), RankedScores()
+        for user_id, counter in rolling_posts.get(chat_id, {}).items():
+            posts_day, posts_week = counter.counts(bucket)
+            if posts_day:
+                day[user_id] = posts_day
+            if posts_week:
+                week[user_id] = posts_week
+        cached = rolling_ranks[chat_id] = (bucket, day, week)
+    return cached[1], cached[2]
+
+def evict_idle_rolling(chat_id: int):
+    """Drop counters with nothing left in the weekly window"""
+    bucket = bucket_of(now_utc())
+    counters = rolling_posts.get(chat_id, {})
+    for user_id in [u for u, counter in counters.items() if not counter.counts(bucket)[1]]:
+        del counters[user_id]
+
+def roll_periods(chat_id: int):
+    """Reset a chat's daily/weekly counters if a reset job closed their period"""
+    epochs = chat_epochs.get(chat_id)
+    if epochs is None:  # First seen: its counters (if any) belong to the current period
+        chat_epochs[chat_id] = dict(period_epochs)
+        touch_meta()
+        return
+    for period, reset in (("daily", reset_daily), ("weekly", reset_weekly)):
+        if epochs.get(period, 0) != period_epochs[period]:
+            reset(chat_id)
+            epochs[period] = period_epochs[period]
+            touch_meta()
+            record(Ev.Reset, chat_id, 0, epochs[period], text=period)
+
+def final_standings(period: str, table: Dict[int, RankedScores]) -> List[Tuple[int, int, int]]:
+    """(chat_id, leader, score) for chats with counters in the period about to close"""
+    epoch = period_epochs[period]
+    leaders = []
+    for chat_id in list(known_chats):
+        if chat_epochs.get(chat_id, period_epochs).get(period, 0) != epoch:
+            continue  # Untouched since an earlier close: counters are stale
+        scores = table.get(chat_id)
+        if scores:
+            top_uid, top_score = scores.top(1)[0]
+            if top_score > 0:
+                leaders.append((chat_id, top_uid, top_score))
+    return leaders
+
+def advance_period(period: str):
+    """Close the current daily/weekly period for every chat at once (O(1))"""
+    period_epochs[period] += 1
+    touch_meta()
+    record(Ev.Reset, 0, 0, period_epochs[period], text=period)
+
+def reset_tz():
+    """WEEKLY_RESET_TZ as a tzinfo; plain UTC needs no tz database (tzdata)"""
+    return UTC if WEEKLY_RESET_TZ == "UTC" else ZoneInfo(WEEKLY_RESET_TZ)
+
+def weekly_boundary(when: datetime) -> datetime:
+    """The latest weekly reset boundary at or before `when` (DST-aware)"""
+    tz = reset_tz()
+    local = when.astimezone(tz)
+    day = local.date() - timedelta(days=(local.weekday() - WEEKLY_RESET_WEEKDAY) % 7)
+    boundary = datetime.combine(day, WEEKLY_RESET_TIME, tzinfo=tz).astimezone(UTC)
+    if boundary > when:  # Compared as instants: wall-clock times are ambiguous around DST changes
+        boundary = datetime.combine(day - timedelta(days=7), WEEKLY_RESET_TIME, tzinfo=tz).astimezone(UTC)
+    return boundary
+
+def next_weekly_boundary(when: datetime) -> datetime:
+    local = weekly_boundary(when).astimezone(reset_tz())
+    return datetime.combine(local.date() + timedelta(days=7), WEEKLY_RESET_TIME, tzinfo=local.tzinfo).astimezone(UTC)
+
+def schedule_weekly_reset(job_queue, retry_in: Optional[timedelta] = None):
+    """Arm job_weekly_reset for the next boundary, or now if one was missed.
+
+    A reset that failed leaves its boundary pending; `retry_in` delays the
+    next attempt so the failure is not retried in a hot loop.
+    """
+    now = now_utc()
+    boundary = weekly_boundary(now)
+    if "weekly" not in period_boundaries:
+        # First run with wall-clock resets: the running week counts as started
+        period_boundaries["weekly"] = boundary.timestamp()
+        touch_meta()
+    if period_boundaries["weekly"] < boundary.timestamp():
+        job_queue.run_once(job_weekly_reset, when=retry_in or 0)  # Catch up once, however many were missed
+    else:
+        job_queue.run_once(job_weekly_reset, when=next_weekly_boundary(now))
+
+def update_streak(chat_id: int, user_id: int, when: Optional[datetime] = None):
+    when = when or now_utc()
+    today = when.date()
     last_post = last_post_date[chat_id].get(user_id)
+    streak_index.move(chat_id, user_id, last_post.date() if last_post else None, today)
     
     if last_post:
         last_date = last_post.date()
@@ -491,7 +3081,8 @@ def update_streak(chat_id: int, user_id: int):
     else:
         user_streaks[chat_id][user_id] = 1
     
-    last_post_date[chat_id][user_id] = now_utc()
+    last_post_date[chat_id][user_id] = when
+    touch(chat_id, user_id)
 
 async def process_referral_signup(context: ContextTypes.DEFAULT_TYPE, chat_id: int, referee_id: int, referrer_id: int):
     """Process a new referral signup"""
@@ -501,16 +3092,13 @@ async def process_referral_signup(context: ContextTypes.DEFAULT_TYPE, chat_id: i
     # Award signup bonus to referrer
     signup_coins = award_coins(chat_id, referrer_id, COIN_REFERRAL_SIGNUP, "Referral signup bonus", "referral")
     
-    # Update referral stats
-    referral_stats[chat_id][referrer_id]["total_referrals"] += 1
-    weekly_referral_count[chat_id][referrer_id] += 1
-    
-    # Store referral relationship
-    referral_relationships[chat_id][referee_id] = referrer_id
+    # Update referral stats and store the relationship
+    apply_referral(chat_id, referee_id, referrer_id)
+    record(Ev.Referral, chat_id, referee_id, referrer_id)
     
     # Notify both users
-    referrer_mention = await mention(context.application, chat_id, referrer_id)
-    referee_mention = await mention(context.application, chat_id, referee_id)
+    referrer_mention = user_tag(referrer_id)
+    referee_mention = user_tag(referee_id)
     
     await safe_notify(
         context, 
@@ -542,10 +3130,12 @@ async def check_referral_milestone(context: ContextTypes.DEFAULT_TYPE, chat_id:
         # Update stats
         referral_stats[chat_id][referrer_id]["active_referrals"] += 1
         referral_milestones_claimed[chat_id].add(milestone_key)
+        touch(chat_id, referee_id)
+        record(Ev.Milestone, chat_id, referee_id, referrer_id)
         
         # Notify
-        referrer_mention = await mention(context.application, chat_id, referrer_id)
-        referee_mention = await mention(context.application, chat_id, referee_id)
+        referrer_mention = user_tag(referrer_id)
+        referee_mention = user_tag(referee_id)
         
         await safe_notify(
             context,
@@ -561,14 +3151,14 @@ async def check_referral_milestone(context: ContextTypes.DEFAULT_TYPE, chat_id:
             await grant_ach(context, chat_id, referrer_id, Ach.ReferralMaster, "🤝 <b>Referral Master</b> — 10 active referrals!")
             # Also unlock Referral Champion badge
             if "🤝 Referral Champion" not in achievements[chat_id][referrer_id]:
-                achievements[chat_id][referrer_id].add("🤝 Referral Champion")
-                await safe_notify(context, chat_id, f"🤝 {(await mention(context.application, chat_id, referrer_id))} unlocked badge: <b>Referral Champion</b> — 10+ active referrals! 🎉")
+                add_achievement(chat_id, referrer_id, "🤝 Referral Champion")
+                await safe_notify(context, chat_id, f"🤝 {user_tag(referrer_id)} unlocked badge: <b>Referral Champion</b> — 10+ active referrals! 🎉")
         if active_referrals == 25:
             await grant_ach(context, chat_id, referrer_id, Ach.CommunityBuilder, "🏗️ <b>Community Builder</b> — 25 active referrals!")
             # Also unlock Community Builder badge
             if "🏗️ Community Builder" not in achievements[chat_id][referrer_id]:
-                achievements[chat_id][referrer_id].add("🏗️ Community Builder")
-                await safe_notify(context, chat_id, f"🏗️ {(await mention(context.application, chat_id, referrer_id))} unlocked badge: <b>Community Builder</b> — 25+ active referrals! 🎉")
+                add_achievement(chat_id, referrer_id, "🏗️ Community Builder")
+                await safe_notify(context, chat_id, f"🏗️ {user_tag(referrer_id)} unlocked badge: <b>Community Builder</b> — 25+ active referrals! 🎉")
 
 async def cmd_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
@@ -581,16 +3171,13 @@ async def cmd_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
         stats = referral_stats[cid][uid]
         
         # Get list of referred users
+        referee_ids = [referee_id for referee_id, referrer_id in referral_relationships[cid].items() if referrer_id == uid]
+        names = await mentions(context.application, cid, referee_ids)
         referred_users = []
-        for referee_id, referrer_id in referral_relationships[cid].items():
-            if referrer_id == uid:
-                try:
-                    referee_mention = await mention(context.application, cid, referee_id)
-                    posts = total_content_count[cid][referee_id]
-                    status = "✅ Active" if posts >= REFERRAL_ACTIVITY_THRESHOLD else f"📊 {posts}/{REFERRAL_ACTIVITY_THRESHOLD} posts"
-                    referred_users.append(f"  • {referee_mention} ({status})")
-                except:
-                    continue
+        for referee_id in referee_ids:
+            posts = total_content_count[cid][referee_id]
+            status = "✅ Active" if posts >= REFERRAL_ACTIVITY_THRESHOLD else f"📊 {posts}/{REFERRAL_ACTIVITY_THRESHOLD} posts"
+            referred_users.append(f"  • {names[referee_id]} ({status})")
         
         referred_text = "\n".join(referred_users) if referred_users else "  None yet"
         
@@ -687,6 +3274,23 @@ async def cmd_streak(update: Update, context: ContextTypes.DEFAULT_TYPE):
         emoji = "🚀" if streak >= 7 else "🔥" if streak >= 3 else "💪"
         await reply_in_same_topic(update, f"🔥 Current streak: <b>{streak} days</b> {emoji}{protection}")
 
+def rank_line(scores: RankedScores, user_id: int) -> str:
+    """'#rank of n (top p%)' from the chat's rank index, O(log n)"""
+    rank = scores.rank(user_id) if scores.get(user_id, 0) > 0 else None
+    if rank is None:
+        return "unranked"
+    percentile = max(1, -(-100 * rank // len(scores)))
+    return f"#{rank} of {len(scores)} (top {percentile}%)"
+
+def standings_text(chat_id: int, user_id: int) -> str:
+    return (
+        f"🏆 <b>Standings:</b>\n"
+        f"  • Today: {rank_line(daily_content_count[chat_id], user_id)}\n"
+        f"  • Week: {rank_line(weekly_content_count[chat_id], user_id)}\n"
+        f"  • All-time: {rank_line(total_content_count[chat_id], user_id)}\n"
+        f"  • XP: {rank_line(xp_levels[chat_id], user_id)}"
+    )
+
 async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     uid = update.effective_user.id
@@ -762,7 +3366,8 @@ async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔥 <b>Streak:</b> {streak} days\n"
         f"🏅 <b>Achievements:</b> {achievement_count}\n\n"
         f"📊 <b>Posts:</b> Today: {daily_posts} | Week: {weekly_posts} | Total: {total_posts}\n"
-        f"📈 <b>Content:</b> {content_text}"
+        f"📈 <b>Content:</b> {content_text}\n"
+        f"{standings_text(cid, uid)}"
         f"{join_info}"
         f"{referral_info}"
         f"{boost_text}"
@@ -776,9 +3381,10 @@ async def grant_ach(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: i
     has = achievements[chat_id][user_id]
     if ach_name in has:
         return
-    has.add(ach_name)
+    add_achievement(chat_id, user_id, ach_name)
     coins_earned = award_coins(chat_id, user_id, 25, f"Achievement: {ach_name}")
-    await safe_notify(context, chat_id, f"🏅 {(await mention(context.application, chat_id, user_id))} unlocked: {announce} (+{coins_earned} coins!)")
+    await safe_notify(context, chat_id, f"🏅 {user_tag(user_id)} unlocked: {announce} (+{coins_earned} coins!)",
+                      key=f"ach:{chat_id}:{user_id}:{ach_name}")
 
 async def check_achievements(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, content_type: str):
     total = total_content_count[chat_id][user_id]
@@ -796,9 +3402,7 @@ async def check_achievements(context: ContextTypes.DEFAULT_TYPE, chat_id: int, u
     elif streak == 30:
         await grant_ach(context, chat_id, user_id, Ach.StreakMaster30, "👑 <b>30-Day Streak</b> — legendary dedication!")
 
-    # Content type achievements
-    content_type_count[chat_id][user_id][content_type] += 1
-    
+    # Content type achievements (content_type_count is updated in on_message)
     if content_type == "photo" and content_type_count[chat_id][user_id]["photo"] == 50:
         await grant_ach(context, chat_id, user_id, Ach.PhotoMaster, "📸 <b>Photo Master</b> — 50 photos shared!")
     elif content_type == "video" and content_type_count[chat_id][user_id]["video"] == 25:
@@ -825,19 +3429,19 @@ async def check_achievements(context: ContextTypes.DEFAULT_TYPE, chat_id: int, u
     
     # Content King badge (50+ weekly posts)
     if weekly_posts >= 50 and "👑 Content King" not in achievements[chat_id][user_id]:
-        achievements[chat_id][user_id].add("👑 Content King")
-        await safe_notify(context, chat_id, f"👑 {(await mention(context.application, chat_id, user_id))} unlocked badge: <b>Content King</b> — 50+ weekly posts! 🎉")
+        add_achievement(chat_id, user_id, "👑 Content King")
+        await safe_notify(context, chat_id, f"👑 {user_tag(user_id)} unlocked badge: <b>Content King</b> — 50+ weekly posts! 🎉")
     
     # Consistency Champion badge (14+ day streak)
     if streak >= 14 and "🏆 Consistency Champion" not in achievements[chat_id][user_id]:
-        achievements[chat_id][user_id].add("🏆 Consistency Champion")
-        await safe_notify(context, chat_id, f"🏆 {(await mention(context.application, chat_id, user_id))} unlocked badge: <b>Consistency Champion</b> — 14+ day streak! 🎉")
+        add_achievement(chat_id, user_id, "🏆 Consistency Champion")
+        await safe_notify(context, chat_id, f"🏆 {user_tag(user_id)} unlocked badge: <b>Consistency Champion</b> — 14+ day streak! 🎉")
     
     # Early Adopter badge (first 10 members)
     total_users = len(user_join_dates[chat_id])
     if total_users <= 10 and user_id in user_join_dates[chat_id] and "🚀 Early Adopter" not in achievements[chat_id][user_id]:
-        achievements[chat_id][user_id].add("🚀 Early Adopter")
-        await safe_notify(context, chat_id, f"🚀 {(await mention(context.application, chat_id, user_id))} unlocked badge: <b>Early Adopter</b> — among first 10 members! 🎉")
+        add_achievement(chat_id, user_id, "🚀 Early Adopter")
+        await safe_notify(context, chat_id, f"🚀 {user_tag(user_id)} unlocked badge: <b>Early Adopter</b> — among first 10 members! 🎉")
     
     # Check referral milestone after each post
     await check_referral_milestone(context, chat_id, user_id)
@@ -855,58 +3459,52 @@ async def cmd_chatid(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
-    top_posters = sorted(
-        ((user_id, daily_content_count[cid][user_id]) for user_id in daily_content_count[cid]),
-        key=lambda x: x[1], reverse=True
-    )[:10]
+    rolling = bool(context.args) and context.args[0].lower() == "rolling"
+    if rolling:
+        standings = rolling_scores(cid)[0]
+        top_posters = standings.top(10)
+        total_posts_today = standings.total
+        active_users_today = len(standings)
+    else:
+        top_posters = daily_content_count[cid].top(10)
+        total_posts_today = daily_content_count[cid].total
+        active_users_today = len(daily_content_count[cid])
     
     top_posters_text = ""
     if top_posters:
-        poster_lines = []
-        for user_id, count in top_posters:
-            try:
-                user_mention = await mention(context.application, cid, user_id)
-                poster_lines.append(f"{user_mention}: {count} posts")
-            except Exception as e:
-                print(f"Error mentioning user {user_id}: {e}")
-                poster_lines.append(f"User {user_id}: {count} posts")
-        top_posters_text = "\n".join(poster_lines)
+        names = await mentions(context.application, cid, (user_id for user_id, _ in top_posters))
+        top_posters_text = "\n".join(f"{names[user_id]}: {count} posts" for user_id, count in top_posters)
     else:
         top_posters_text = "No posts yet."
 
-    today_utc = now_utc().strftime("%Y-%m-%d")
-    
-    total_posts_today = sum(daily_content_count[cid].values())
-    active_users_today = len(daily_content_count[cid])
+    if rolling:
+        title = f"📊 <b>Last {fmt_span(DAILY_WINDOW)} Stats</b> (rolling)\n"
+        heading = f"🏆 <b>Top Posters (last {fmt_span(DAILY_WINDOW)})</b>"
+    else:
+        title = f"📊 <b>Today's Stats</b> (UTC: {now_utc().strftime('%Y-%m-%d')})\n"
+        heading = "🏆 <b>Top Posters Today</b>"
     
     await reply_in_same_topic(
         update,
-        f"📊 <b>Today's Stats</b> (UTC: {today_utc})\n"
+        title +
         f"Total Posts: {total_posts_today}\n"
         f"Active Users: {active_users_today}\n\n"
-        f"🏆 <b>Top Posters Today</b>:\n{top_posters_text}"
+        f"{heading}:\n{top_posters_text}"
     )
 
 async def cmd_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
-    top_posters = sorted(
-        ((user_id, daily_content_count[cid][user_id]) for user_id in daily_content_count[cid]),
-        key=lambda x: x[1], reverse=True
-    )[:5]
+    top_posters = daily_content_count[cid].top(5)
     
     if not top_posters:
         await reply_in_same_topic(update, "🏆 No posts today yet! Be the first to share something!")
         return
     
+    names = await mentions(context.application, cid, (user_id for user_id, _ in top_posters))
     top_text = []
     for i, (user_id, count) in enumerate(top_posters, 1):
         emoji = ["🥇", "🥈", "🥉", "🏅", "⭐"][min(i-1, 4)]
-        try:
-            name = await mention(context.application, cid, user_id)
-            top_text.append(f"{emoji} {name}: <b>{count}</b> posts")
-        except Exception as e:
-            print(f"Error mentioning user {user_id}: {e}")
-            top_text.append(f"{emoji} User {user_id}: <b>{count}</b> posts")
+        top_text.append(f"{emoji} {names[user_id]}: <b>{count}</b> posts")
     
     await reply_in_same_topic(
         update,
@@ -946,42 +3544,43 @@ async def cmd_badges(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
+    rolling = bool(context.args) and context.args[0].lower() == "rolling"
     
-    weekly_leaders = sorted(
-        ((user_id, weekly_content_count[cid][user_id]) for user_id in weekly_content_count[cid]),
-        key=lambda x: x[1], reverse=True
-    )[:10]
+    if rolling:
+        weekly_leaders = rolling_scores(cid)[1].top(10)
+    else:
+        weekly_leaders = weekly_content_count[cid].top(10)
     
     if not weekly_leaders:
         await reply_in_same_topic(update, "📈 No posts this week yet! Be the first to climb the leaderboard!")
         return
     
+    names = await mentions(context.application, cid, (user_id for user_id, _ in weekly_leaders))
     leaderboard_text = []
     for i, (user_id, count) in enumerate(weekly_leaders, 1):
         emoji = ["🏆", "🥈", "🥉"] + ["🏅"] * 7
-        name = await mention(context.application, cid, user_id)
+        name = names[user_id]
         leaderboard_text.append(f"{emoji[min(i-1, len(emoji)-1)]} {name}: <b>{count}</b> posts")
     
     await reply_in_same_topic(
         update,
-        f"📈 <b>Weekly Leaderboard</b>\n\n" + "\n".join(leaderboard_text)
+        (f"📈 <b>Leaderboard (last {fmt_span(WEEKLY_WINDOW)})</b>\n\n" if rolling else "📈 <b>Weekly Leaderboard</b>\n\n")
+        + "\n".join(leaderboard_text)
     )
 
 async def cmd_reactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     
-    reaction_leaders = sorted(
-        ((user_id, weekly_reaction_totals[cid][user_id]) for user_id in weekly_reaction_totals[cid]),
-        key=lambda x: x[1], reverse=True
-    )[:5]
+    reaction_leaders = weekly_reaction_totals[cid].top(5)
     
     if not reaction_leaders:
         await reply_in_same_topic(update, "❤️ No reactions tracked this week yet! Start reacting to posts to spread the love!")
         return
     
+    names = await mentions(context.application, cid, (user_id for user_id, _ in reaction_leaders))
     reaction_text = []
     for user_id, reactions in reaction_leaders:
-        name = await mention(context.application, cid, user_id)
+        name = names[user_id]
         reaction_text.append(f"❤️ {name}: <b>{reactions}</b> reactions received")
     
     await reply_in_same_topic(
@@ -989,22 +3588,50 @@ async def cmd_reactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"❤️ <b>Weekly Reaction Report</b>\n\n" + "\n".join(reaction_text)
     )
 
+def message_link(chat_id: int, message_id: int) -> Optional[str]:
+    """t.me/c link to a post; None for basic groups, which have no message links"""
+    # Supergroup ids are -100<internal id>; t.me/c links use the internal id
+    if not str(chat_id).startswith("-100"):
+        return None
+    return f"https://t.me/c/{str(chat_id)[4:]}/{message_id}"
+
+async def cmd_loved(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cid = update.effective_chat.id
+    loved = weekly_most_loved[cid].top()
+    
+    if not loved:
+        await reply_in_same_topic(update, "💖 No loved posts this week yet! React to your favourite posts!")
+        return
+    
+    medals = ["🥇", "🥈", "🥉"]
+    names = await mentions(context.application, cid, (author_id for _, author_id, _ in loved))
+    loved_text = []
+    for i, (message_id, author_id, reactions) in enumerate(loved):
+        medal = medals[i] if i < len(medals) else f"{i + 1}."
+        name = names[author_id]
+        link = message_link(cid, message_id)
+        post = f'<a href="{link}">Post</a>' if link else "Post"
+        loved_text.append(f'{medal} {post} by {name}: <b>{reactions}</b> ❤️')
+    
+    await reply_in_same_topic(
+        update,
+        f"💖 <b>Most Loved Posts This Week</b>\n\n" + "\n".join(loved_text)
+    )
+
 async def cmd_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     
-    all_time_leaders = sorted(
-        ((user_id, total_content_count[cid][user_id]) for user_id in total_content_count[cid]),
-        key=lambda x: x[1], reverse=True
-    )[:10]
+    all_time_leaders = total_content_count[cid].top(10)
     
     if not all_time_leaders:
         await reply_in_same_topic(update, "🏅 No content posted yet! Be the first to earn a spot in the all-time rankings!")
         return
     
+    names = await mentions(context.application, cid, (user_id for user_id, _ in all_time_leaders))
     ranking_text = []
     for i, (user_id, count) in enumerate(all_time_leaders, 1):
         emoji = ["👑", "🥈", "🥉"] + ["🏅"] * 7
-        name = await mention(context.application, cid, user_id)
+        name = names[user_id]
         level = calc_level(xp_levels[cid][user_id])
         ranking_text.append(f"{emoji[min(i-1, len(emoji)-1)]} {name}: <b>{count}</b> posts (Level {level})")
     
@@ -1031,12 +3658,16 @@ async def cmd_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
             custom_title = " ".join(parts[1:])[:30]  # Limit to 30 chars
             user_titles[cid][uid] = custom_title
             user_inventory[cid][uid].remove("Custom Title")
+            touch(cid, uid)
+            record(Ev.Title, cid, uid, 1, text=custom_title)
             await reply_in_same_topic(update, f"✅ Title set to: <b>{custom_title}</b>")
         else:
             await reply_in_same_topic(update, "❌ You need to purchase a Custom Title from the shop first!")
     elif len(parts) == 1 and parts[0] == "reset":
         if uid in user_titles[cid]:
             del user_titles[cid][uid]
+            touch(cid, uid)
+            record(Ev.Title, cid, uid, 0)
             new_title = get_user_title(cid, uid)
             await reply_in_same_topic(update, f"✅ Title reset to: <b>{new_title}</b>")
         else:
@@ -1085,33 +3716,28 @@ async def cmd_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_balance = user_coins[cid][uid]
             
             if user_balance >= item["price"]:
-                user_coins[cid][uid] -= item["price"]
+                apply_purchase(cid, uid, item_id, now_utc())
+                record(Ev.Purchase, cid, uid, text=item_id)
                 
                 if item["type"] == "boost":
-                    expiry = now_utc() + item["duration"]
-                    active_boosts[cid][uid][item_id] = expiry
                     await reply_in_same_topic(
                         update,
                         f"✅ Purchased <b>{item['name']}</b>! Active for {fmt_span(item['duration'])}. "
                         f"Remaining balance: <b>{user_coins[cid][uid]}</b> coins."
                     )
                 elif item["type"] == "title":
-                    user_inventory[cid][uid].append(item["name"])
                     await reply_in_same_topic(
                         update,
                         f"✅ Purchased <b>{item['name']}</b>! Use <code>/title set [custom_title]</code> to use it. "
                         f"Remaining balance: <b>{user_coins[cid][uid]}</b> coins."
                     )
                 elif item["type"] == "protection":
-                    expiry = now_utc() + item["duration"]
-                    active_boosts[cid][uid]["streak_freeze"] = expiry  # Changed from "streak_protection"
                     await reply_in_same_topic(
                         update,
                         f"✅ Purchased <b>{item['name']}</b>! Your streak is protected for {fmt_span(item['duration'])}. "
                         f"Remaining balance: <b>{user_coins[cid][uid]}</b> coins."
                     )
                 elif item["type"] == "cosmetic":
-                    user_inventory[cid][uid].append(item["name"])
                     await reply_in_same_topic(
                         update,
                         f"✅ Purchased <b>{item['name']}</b>! It has been added to your inventory. "
@@ -1162,161 +3788,385 @@ async def cmd_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"⭐ {await mention(context.application, cid, uid)}\n"
         f"Level: <b>{level}</b> (XP: <b>{xp}</b>)\n"
         f"Coins: <b>{coins}</b>\n"
-        f"Title: {title}"
+        f"Title: {title}\n\n"
+        f"{standings_text(cid, uid)}"
+    )
+
+# ========= DEADLINES =========
+class DeadlineIndex:
+    """One min-heap for all per-member deadlines, with lazy invalidation.
+
+    Entries are (when, kind, chat_id, user_id) with at most one per
+    (kind, chat, user). State changes (a first post, new activity) never
+    touch the heap: when an entry comes due, the kind's due function
+    recomputes the member's real deadline from current state, and the
+    entry is dropped (None), pushed back (still in the future) or returned
+    for action. A tick therefore costs O(1) unless something is due, and a
+    raid of thousands of joins is thousands of O(log n) pushes.
+    """
+
+    def __init__(self, due: Dict[int, Callable[[int, int], Optional[datetime]]]):
+        self.due = due
+        self.heap: List[Tuple[float, int, int, int]] = []
+        self.scheduled: Set[Tuple[int, int, int]] = set()
+        self.built = False
+        self.fired = 0
+        self.deferred = 0
+
+    def schedule(self, kind: int, chat_id: int, user_id: int, when: datetime):
+        """Look at this member no earlier than `when` (no-op if an entry exists)"""
+        key = (kind, chat_id, user_id)
+        if key in self.scheduled:
+            return
+        self.scheduled.add(key)
+        heapq.heappush(self.heap, (when.timestamp(), kind, chat_id, user_id))
+
+    def reschedule(self, kind: int, chat_id: int, user_id: int):
+        """Queue the member's next deadline after acting on the current one"""
+        when = self.due[kind](chat_id, user_id)
+        if when is not None:
+            self.schedule(kind, chat_id, user_id, when)
+
+    def rebuild(self, entries: Iterable[Tuple[int, int, int, datetime]]):
+        for kind, chat_id, user_id, when in entries:
+            self.schedule(kind, chat_id, user_id, when)
+        self.built = True
+
+    def pop_due(self, now: datetime) -> List[Tuple[int, int, int]]:
+        cutoff = now.timestamp()
+        fired = []
+        while self.heap and self.heap[0][0] <= cutoff:
+            _, kind, chat_id, user_id = heapq.heappop(self.heap)
+            self.scheduled.discard((kind, chat_id, user_id))
+            when = self.due[kind](chat_id, user_id)
+            if when is None:
+                continue
+            if when > now:
+                self.deferred += 1
+                self.schedule(kind, chat_id, user_id, when)
+            else:
+                fired.append((kind, chat_id, user_id))
+        self.fired += len(fired)
+        return fired
+
+    def summary(self) -> str:
+        return f"entries={len(self.heap)} fired={self.fired} deferred={self.deferred}"
+
+def new_member_due(chat_id: int, user_id: int) -> Optional[datetime]:
+    """The pre-deadline warning, then the kick; None once the member has posted"""
+    deadline = new_member_deadline.get(chat_id, {}).get(user_id)
+    if deadline is None:
+        return None
+    return deadline if user_id in new_member_warned.get(chat_id, ()) else deadline - NEW_MEMBER_WARN_BEFORE
+
+def inactivity_due(chat_id: int, user_id: int) -> Optional[datetime]:
+    """48h warning, or the 72h kick once warned; new members wait for their join deadline"""
+    last_seen = last_activity_utc.get(chat_id, {}).get(user_id)
+    if last_seen is None:
+        return None
+    joined_deadline = new_member_deadline.get(chat_id, {}).get(user_id)
+    if joined_deadline is not None:
+        return max(joined_deadline + CHECK_INTERVAL, last_seen + INACTIVITY_WARN_AT)
+    return last_seen + (INACTIVITY_KICK_AT if user_id in warned_48h.get(chat_id, ()) else INACTIVITY_WARN_AT)
+
+deadlines = DeadlineIndex({WARN_NEW_MEMBER: new_member_due, WARN_INACTIVE: inactivity_due})
+
+def restore_deadlines():
+    """Index every persisted join deadline and last activity (after a restart)"""
+    ensure_all_loaded()
+    deadlines.rebuild(
+        [(WARN_NEW_MEMBER, chat_id, uid, deadline - NEW_MEMBER_WARN_BEFORE)
+         for chat_id, members in new_member_deadline.items()
+         for uid, deadline in members.items()]
+        + [(WARN_INACTIVE, chat_id, uid, last_seen + INACTIVITY_WARN_AT)
+           for chat_id, activity in last_activity_utc.items()
+           for uid, last_seen in activity.items()]
     )
 
+# ========= STREAK INDEX =========
+class StreakIndex:
+    """Per-chat buckets of user ids keyed by the date of their last post.
+
+    A streak can only break for users whose last post is at least two days
+    old, so the checker pops just those buckets instead of scanning every
+    member. Users kept alive by a streak freeze are put back and looked at
+    again on the next check.
+    """
+
+    def __init__(self):
+        self.buckets: Dict[int, Dict[date, Set[int]]] = defaultdict(dict)
+        self.built = False
+
+    def move(self, chat_id: int, user_id: int, old: Optional[date], new: date):
+        if old == new:
+            return
+        buckets = self.buckets[chat_id]
+        if old is not None and old in buckets:
+            buckets[old].discard(user_id)
+            if not buckets[old]:
+                del buckets[old]
+        buckets.setdefault(new, set()).add(user_id)
+
+    def restore(self, chat_id: int, day: date, user_ids: Set[int]):
+        self.buckets[chat_id].setdefault(day, set()).update(user_ids)
+
+    def pop_lapsed(self, today: date) -> List[Tuple[int, date, Set[int]]]:
+        """Remove and return every bucket whose users have missed a whole day"""
+        cutoff = today - timedelta(days=1)
+        lapsed = []
+        for chat_id, buckets in self.buckets.items():
+            for day in [day for day in buckets if day < cutoff]:
+                lapsed.append((chat_id, day, buckets.pop(day)))
+        return lapsed
+
+    def rebuild(self):
+        ensure_all_loaded()
+        for chat_id, posts in last_post_date.items():
+            for user_id, last_post in posts.items():
+                self.move(chat_id, user_id, None, last_post.date())
+        self.built = True
+
+streak_index = StreakIndex()
+
+def posted_last_on(chat_id: int, user_id: int, day: date) -> bool:
+    last_post = last_post_date.get(chat_id, {}).get(user_id)
+    return last_post is not None and last_post.date() == day
+
 # ========= JOBS =========
-async def job_new_member_enforcer(context: ContextTypes.DEFAULT_TYPE):
-    now = now_utc()
-    all_chats = list(known_chats)
-    
-    for chat_id in all_chats:
-        try:
-            overdue = []
-            warn_list = []
-            for uid, deadline in list(new_member_deadline[chat_id].items()):
-                if now >= deadline:
-                    overdue.append(uid)
-                elif now >= deadline - NEW_MEMBER_WARN_BEFORE and uid not in new_member_warned[chat_id]:
-                    warn_list.append(uid)
-            
-            # Warn new members before deadline
-            for uid in warn_list:
+class JobFanOut:
+    """Runs periodic jobs' per-chat work concurrently under one global limit.
+
+    At most `concurrency` chats are worked on at once across all jobs, each
+    chat's work is cancelled after `timeout`, and every tick starts from a
+    different point in the chat order so no chat is always served last. A
+    job whose previous tick is still running skips the new tick (counted
+    as an overrun) instead of overlapping it.
+    """
+
+    def __init__(self, concurrency: int, timeout: timedelta):
+        self.concurrency = concurrency
+        self.timeout = timeout.total_seconds()
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.cursors: Dict[str, int] = defaultdict(int)
+        self.running: Set[str] = set()
+        self.overruns: Dict[str, int] = defaultdict(int)
+        self.timeouts = 0
+        self.slowest: Dict[str, float] = defaultdict(float)
+
+    def exclusive(self, interval: timedelta):
+        """Decorator: skip a tick while the previous one runs; warn when a tick outlasts `interval`"""
+        def wrap(job):
+            name = job.__name__
+
+            @wraps(job)
+            async def run(context: ContextTypes.DEFAULT_TYPE):
+                if name in self.running:
+                    self.overruns[name] += 1
+                    print(f"{name}: previous tick still running, skipped ({self.overruns[name]} so far)")
+                    return
+                self.running.add(name)
+                started = monotonic()
                 try:
-                    name_link = await mention(context.application, chat_id, uid)
-                    await safe_notify(context, chat_id, f"⚠️ {name_link} welcome! Please post something within 15 minutes to stay in the group.")
-                    new_member_warned[chat_id].add(uid)
-                except Exception as e:
-                    print(f"Failed to warn new member {uid} in {chat_id}: {e}")
-            
-            # Remove overdue new members
-            for uid in overdue:
+                    await job(context)
+                finally:
+                    self.running.discard(name)
+                    elapsed = monotonic() - started
+                    self.slowest[name] = max(self.slowest[name], elapsed)
+                    if elapsed > interval.total_seconds():
+                        print(f"{name}: tick took {elapsed:.1f}s, longer than its {fmt_span(interval)} interval")
+            return run
+        return wrap
+
+    async def run(self, name: str, chat_ids: Iterable[int], work: Callable[[int], Awaitable[None]]):
+        chats = sorted(set(chat_ids))
+        if not chats:
+            return
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        start = self.cursors[name] % len(chats)
+        self.cursors[name] += self.concurrency
+        semaphore = self.semaphore
+
+        async def one(chat_id: int):
+            async with semaphore:
                 try:
-                    await context.bot.ban_chat_member(chat_id, uid)
-                    name_link = await mention(context.application, chat_id, uid)
-                    await safe_notify(context, chat_id, f"👋 {name_link} was removed for not posting within the time limit.")
-                    new_member_deadline[chat_id].pop(uid, None)
-                    new_member_warned[chat_id].discard(uid)
+                    await asyncio.wait_for(work(chat_id), self.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    print(f"{name}: chat {chat_id} timed out after {self.timeout:.0f}s")
                 except Exception as e:
-                    print(f"Failed to kick new member {uid} from {chat_id}: {e}")
-                    
-        except Exception as e:
-            print(f"Error in new member enforcer for chat {chat_id}: {e}")
+                    print(f"Error in {name} for chat {chat_id}: {e}")
 
-async def job_inactivity(context: ContextTypes.DEFAULT_TYPE):
+        await asyncio.gather(*(one(chat_id) for chat_id in chats[start:] + chats[:start]))
+
+    def summary(self) -> str:
+        slowest = ", ".join(f"{name}={seconds:.1f}s" for name, seconds in sorted(self.slowest.items()))
+        return f"timeouts={self.timeouts} overruns={dict(self.overruns)} slowest: {slowest or 'n/a'}"
+
+fan_out = JobFanOut(JOB_CHAT_CONCURRENCY, JOB_CHAT_TIMEOUT)
+
+@fan_out.exclusive(DEADLINE_TICK)
+async def job_deadlines(context: ContextTypes.DEFAULT_TYPE):
+    """Act on every join/inactivity deadline that has passed; O(1) when none is due"""
+    if not deadlines.built:
+        restore_deadlines()
     now = now_utc()
-    all_chats = list(known_chats)
-    
-    for chat_id in all_chats:
+    due: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+    for kind, chat_id, uid in deadlines.pop_due(now):
+        due[chat_id].append((kind, uid))
+
+    async def enforce_chat(chat_id: int):
+        items = due[chat_id]
+        done = 0
         try:
-            activity = last_activity_utc[chat_id]
-            kick_list = []
-            warn_list = []
-            
-            for uid, last_seen in list(activity.items()):
-                if uid in new_member_deadline[chat_id]:
-                    continue
-                
-                inactive_dur = now - last_seen
-                if inactive_dur >= INACTIVITY_KICK_AT:
-                    kick_list.append(uid)
-                elif inactive_dur >= INACTIVITY_WARN_AT and uid not in warned_48h[chat_id]:
-                    warn_list.append(uid)
-            
-            for uid in kick_list:
-                try:
-                    cm = await context.bot.get_chat_member(chat_id, uid)
-                    if cm.status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
-                        await context.bot.ban_chat_member(chat_id, uid)
-                        name_link = await mention(context.application, chat_id, uid)
-                        await safe_notify(context, chat_id, f"👋 {name_link} was removed for inactivity (72h).")
-                        
-                        activity.pop(uid, None)
-                        warned_48h[chat_id].discard(uid)
-                except Exception as e:
-                    print(f"Failed to kick inactive user {uid} from {chat_id}: {e}")
-            
-            for uid in warn_list:
+            for kind, uid in items:
                 try:
-                    cm = await context.bot.get_chat_member(chat_id, uid)
-                    if cm.status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
-                        name_link = await mention(context.application, chat_id, uid)
-                        await safe_notify(context, chat_id, f"⚠️ {name_link} you've been inactive for 48h! Post something within 24h or risk removal.")
-                        warned_48h[chat_id].add(uid)
-                except Exception as e:
-                    print(f"Failed to warn inactive user {uid} in {chat_id}: {e}")
-                    
-        except Exception as e:
-            print(f"Error in inactivity job for chat {chat_id}: {e}")
+                    if kind == WARN_NEW_MEMBER:
+                        await enforce_new_member(context, chat_id, uid, now)
+                    else:
+                        await enforce_inactivity(context, chat_id, uid, now)
+                except Exception as e:  # Keep this deadline and go on with the rest of the chat
+                    print(f"Deadline check for {uid} in {chat_id} failed: {e}")
+                    deadlines.schedule(kind, chat_id, uid, now + CHECK_INTERVAL)
+                done += 1
+        finally:
+            for kind, uid in items[done:]:  # Timed out: retry the rest on a later tick
+                deadlines.schedule(kind, chat_id, uid, now + CHECK_INTERVAL)
+
+    await fan_out.run("job_deadlines", due, enforce_chat)
+
+async def enforce_new_member(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, now: datetime):
+    name_link = user_tag(uid)
+    if uid not in new_member_warned[chat_id]:
+        await safe_notify(context, chat_id, f"⚠️ {name_link} welcome! Please post something within 15 minutes to stay in the group.")
+        new_member_warned[chat_id].add(uid)
+        touch(chat_id, uid)
+        record(Ev.Warn, chat_id, uid, WARN_NEW_MEMBER)
+        deadlines.reschedule(WARN_NEW_MEMBER, chat_id, uid)
+        return
+    try:
+        await context.bot.ban_chat_member(chat_id, uid)
+        await safe_notify(context, chat_id, f"👋 {name_link} was removed for not posting within the time limit.",
+                          key=f"kick:{chat_id}:{uid}:{now.date()}")
+        new_member_deadline[chat_id].pop(uid, None)
+        new_member_warned[chat_id].discard(uid)
+        touch(chat_id, uid)
+        record(Ev.Remove, chat_id, uid, WARN_NEW_MEMBER)
+    except Exception as e:
+        print(f"Failed to kick new member {uid} from {chat_id}: {e}")
+        deadlines.schedule(WARN_NEW_MEMBER, chat_id, uid, now + CHECK_INTERVAL)
 
+async def enforce_inactivity(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, now: datetime):
+    if uid in new_member_deadline[chat_id]:  # Still the join deadline's to handle
+        deadlines.schedule(WARN_INACTIVE, chat_id, uid, now + CHECK_INTERVAL)
+        return
+    kick = uid in warned_48h[chat_id]
+    try:
+        if await admin_roster.is_admin(context.bot, chat_id, uid):
+            deadlines.schedule(WARN_INACTIVE, chat_id, uid, now + ADMIN_RECHECK)
+            return
+        name_link = user_tag(uid)
+        if kick:
+            await context.bot.ban_chat_member(chat_id, uid)
+            await safe_notify(context, chat_id, f"👋 {name_link} was removed for inactivity (72h).",
+                              key=f"kick:{chat_id}:{uid}:{now.date()}")
+            last_activity_utc[chat_id].pop(uid, None)
+            warned_48h[chat_id].discard(uid)
+            touch(chat_id, uid)
+            record(Ev.Remove, chat_id, uid, WARN_INACTIVE)
+        else:
+            await safe_notify(context, chat_id, f"⚠️ {name_link} you've been inactive for 48h! Post something within 24h or risk removal.")
+            warned_48h[chat_id].add(uid)
+            touch(chat_id, uid)
+            record(Ev.Warn, chat_id, uid, WARN_INACTIVE)
+            deadlines.reschedule(WARN_INACTIVE, chat_id, uid)
+    except Exception as e:
+        print(f"Failed to {'kick' if kick else 'warn'} inactive user {uid} in {chat_id}: {e}")
+        deadlines.schedule(WARN_INACTIVE, chat_id, uid, now + CHECK_INTERVAL)
+
+@fan_out.exclusive(timedelta(days=1))
 async def job_daily_top(context: ContextTypes.DEFAULT_TYPE):
-    all_chats = list(known_chats)
+    ensure_all_loaded()
+    for chat_id in list(post_reactions):
+        evict_post_reactions(chat_id)
+    for chat_id in list(rolling_posts):
+        evict_idle_rolling(chat_id)
+    print(f"Message author index:\n{message_index_report()}")
+    # Read the final standings before advancing: chats reset lazily from here on
+    leaders = {chat_id: (top_uid, top_score) for chat_id, top_uid, top_score in final_standings("daily", daily_content_count)}
+    advance_period("daily")
     
-    for chat_id in all_chats:
-        try:
-            daily = daily_content_count[chat_id]
-            if daily:
-                top_uid, top_score = max(daily.items(), key=lambda x: x[1])
-                if top_score > 0:
-                    await grant_ach(context, chat_id, top_uid, Ach.TopPosterDay, "🏆 <b>Top Poster (Daily)</b> — you dominated today!")
-                    name_link = await mention(context.application, chat_id, top_uid)
-                    await safe_notify(context, chat_id, f"🏆 <b>Daily Champion</b>\n{name_link} was today's top poster with <b>{top_score}</b> posts! 🎉")
-            
-            daily_content_count[chat_id].clear()
-            
-        except Exception as e:
-            print(f"Error in daily top job for chat {chat_id}: {e}")
+    async def announce(chat_id: int):
+        top_uid, top_score = leaders[chat_id]
+        await grant_ach(context, chat_id, top_uid, Ach.TopPosterDay, "🏆 <b>Top Poster (Daily)</b> — you dominated today!")
+        name_link = user_tag(top_uid)
+        await safe_notify(context, chat_id, f"🏆 <b>Daily Champion</b>\n{name_link} was today's top poster with <b>{top_score}</b> posts! 🎉")
+    
+    await fan_out.run("job_daily_top", leaders, announce)
 
+@fan_out.exclusive(WEEKLY_WINDOW)
 async def job_weekly_reset(context: ContextTypes.DEFAULT_TYPE):
     global current_weekly_challenges
-    all_chats = list(known_chats)
-    
-    for chat_id in all_chats:
-        try:
-            weekly = weekly_content_count[chat_id]
-            if weekly:
-                top_uid, top_score = max(weekly.items(), key=lambda x: x[1])
-                if top_score > 0:
-                    await grant_ach(context, chat_id, top_uid, Ach.WeeklyWarrior, "⚔️ <b>Weekly Warrior</b> — you dominated this week!")
-            
-            weekly_content_count[chat_id].clear()
-            weekly_reaction_totals[chat_id].clear()
-            weekly_most_loved[chat_id].clear()
-            weekly_challenge_progress[chat_id].clear()
-            weekly_challenge_completed[chat_id].clear()
-            weekly_referral_count[chat_id].clear()  # Clear weekly referral counts
-            
-        except Exception as e:
-            print(f"Error in weekly reset job for chat {chat_id}: {e}")
-    
-    current_weekly_challenges = select_weekly_challenges()
-    print(f"New weekly challenges selected: {current_weekly_challenges}")
+    try:
+        boundary = weekly_boundary(now_utc()).timestamp()
+        if period_boundaries.get("weekly", 0) >= boundary:
+            return  # This boundary was already reset (e.g. before a restart)
+        ensure_all_loaded()
+        leaders = {chat_id: top_uid for chat_id, top_uid, _ in final_standings("weekly", weekly_content_count)}
+        advance_period("weekly")
+        period_boundaries["weekly"] = boundary  # Persisted with the epoch in the same meta write
+        
+        async def crown(chat_id: int):
+            await grant_ach(context, chat_id, leaders[chat_id], Ach.WeeklyWarrior, "⚔️ <b>Weekly Warrior</b> — you dominated this week!")
+        
+        await fan_out.run("job_weekly_reset", leaders, crown)
+        
+        current_weekly_challenges = select_weekly_challenges()
+        touch_meta()
+        record(Ev.Challenges, 0, text=",".join(sorted(current_weekly_challenges)))
+        print(f"New weekly challenges selected: {current_weekly_challenges}")
+    finally:
+        # Only delays the next attempt if this one failed before the boundary was recorded
+        schedule_weekly_reset(context.job_queue, retry_in=CHECK_INTERVAL)
 
+@fan_out.exclusive(STREAK_CHECK_INTERVAL)
 async def job_streak_checker(context: ContextTypes.DEFAULT_TYPE):
-    now = now_utc()
-    today = now.date()
-    all_chats = list(known_chats)
+    """Break the streaks of users whose last post lapsed; only their date buckets are visited"""
+    if not streak_index.built:
+        streak_index.rebuild()
+    today = now_utc().date()
+    lapsed: Dict[int, List[Tuple[date, int]]] = defaultdict(list)
+    for chat_id, day, uids in streak_index.pop_lapsed(today):
+        lapsed[chat_id].extend((day, uid) for uid in uids)
     
-    for chat_id in all_chats:
+    async def check_chat(chat_id: int):
+        items = lapsed[chat_id]
+        keep = []  # Frozen, or not reached before a timeout: looked at again next time
+        done = 0
         try:
-            for uid, last_post in list(last_post_date[chat_id].items()):
-                last_date = last_post.date()
-                days_diff = (today - last_date).days
-                
-                if days_diff > 1:
-                    if has_active_boost(chat_id, uid, "streak_freeze"):  # Changed from "streak_protection"
-                        continue
-                    else:
-                        if user_streaks[chat_id][uid] > 0:
-                            old_streak = user_streaks[chat_id][uid]
-                            user_streaks[chat_id][uid] = 0
-                            
-                            if old_streak >= 7:
-                                name_link = await mention(context.application, chat_id, uid)
-                                await safe_notify(context, chat_id, f"💔 {name_link} your {old_streak}-day streak was broken due to inactivity. Start posting again to rebuild it! 💪")
-                
-        except Exception as e:
-            print(f"Error in streak checker for chat {chat_id}: {e}")
+            for day, uid in items:
+                done += 1
+                if not posted_last_on(chat_id, uid, day):  # Posted since the bucket was popped
+                    continue
+                if has_active_boost(chat_id, uid, "streak_freeze"):  # Changed from "streak_protection"
+                    keep.append((day, uid))
+                    continue
+                if user_streaks[chat_id][uid] > 0:
+                    old_streak = user_streaks[chat_id][uid]
+                    user_streaks[chat_id][uid] = 0
+                    touch(chat_id, uid)
+                    record(Ev.Streak, chat_id, uid, 0)
+                    
+                    if old_streak >= 7:
+                        name_link = user_tag(uid)
+                        await safe_notify(context, chat_id, f"💔 {name_link} your {old_streak}-day streak was broken due to inactivity. Start posting again to rebuild it! 💪")
+        finally:
+            keep.extend(items[done:])
+            for day, uid in keep:
+                if posted_last_on(chat_id, uid, day):
+                    streak_index.restore(chat_id, day, {uid})
+    
+    await fan_out.run("job_streak_checker", lapsed, check_chat)
 
 # ========= REACTION HANDLERS =========
 async def on_message_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1332,12 +4182,13 @@ async def on_message_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE
     if chat_id not in known_chats:
         return
     
+    name_cache.note(chat_id, reaction_update.user)
+    
     # Get the message author from our stored data
-    if message_id not in message_authors[chat_id]:
+    author_id = message_authors[chat_id].get(message_id)
+    if author_id is None:
         return
     
-    author_id = message_authors[chat_id][message_id]
-    
     # Skip if user is reacting to their own message
     if user_id == author_id:
         return
@@ -1352,17 +4203,9 @@ async def on_message_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE
     reaction_delta = new_count - old_count
     
     if reaction_delta != 0:
-        # Update reaction totals
-        weekly_reaction_totals[chat_id][author_id] += reaction_delta
-        
-        # Track individual reaction counts for achievements
-        if reaction_delta > 0:
-            post_reactions[chat_id][message_id][user_id] += reaction_delta
-            # Track for weekly most loved posts
-            total_reactions_on_msg = sum(post_reactions[chat_id][message_id].values())
-            weekly_most_loved[chat_id].append((message_id, author_id, total_reactions_on_msg, "❤️"))
-        elif reaction_delta < 0:
-            post_reactions[chat_id][message_id][user_id] = max(0, post_reactions[chat_id][message_id].get(user_id, 0) + reaction_delta)
+        # Update reaction totals and per-message tracking
+        apply_reaction(chat_id, message_id, author_id, user_id, reaction_delta)
+        record(Ev.Reaction, chat_id, author_id, user_id, message_id, reaction_delta)
         
         # Award coins for reactions received
         if reaction_delta > 0:
@@ -1376,14 +4219,18 @@ async def on_message_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE
                     # Check if challenge completed
                     challenge = WEEKLY_CHALLENGES[challenge_id]
                     new_progress = weekly_challenge_progress[chat_id][author_id][challenge_id]
-                    if new_progress >= challenge["target"] and challenge_id not in weekly_challenge_completed[chat_id][author_id]:
+                    completed = new_progress >= challenge["target"] and challenge_id not in weekly_challenge_completed[chat_id][author_id]
+                    if completed:
                         weekly_challenge_completed[chat_id][author_id].add(challenge_id)
+                    record(Ev.Challenge, chat_id, author_id, new_progress, int(challenge_id in weekly_challenge_completed[chat_id][author_id]), text=challenge_id)
+                    if completed:
                         challenge_coins = award_coins(chat_id, author_id, challenge["reward"], f"Challenge: {challenge['name']}")
                         await safe_notify(
                             context,
                             chat_id,
-                            f"🎯 {(await mention(context.application, chat_id, author_id))} completed challenge: "
-                            f"<b>{challenge['name']}</b>! Earned {challenge_coins} coins! 💰"
+                            f"🎯 {user_tag(author_id)} completed challenge: "
+                            f"<b>{challenge['name']}</b>! Earned {challenge_coins} coins! 💰",
+                            key=f"challenge:{chat_id}:{author_id}:{challenge_id}:{period_epochs['weekly']}"
                         )
             
     # Check for reaction-related achievements
@@ -1393,11 +4240,9 @@ async def on_message_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         # Also check for Social Master badge (100+ weekly reactions)
         if "🌟 Social Master" not in achievements[chat_id][author_id]:
-            achievements[chat_id][author_id].add("🌟 Social Master")
-            await safe_notify(context, chat_id, f"🌟 {(await mention(context.application, chat_id, author_id))} unlocked badge: <b>Social Master</b> — 100+ weekly reactions! 🎉")            # Award Love Giver achievement to the reactor
-            reactor_reactions_given = sum(1 for msg_reactions in post_reactions[chat_id].values() 
-                                        for reactor, count in msg_reactions.items() if reactor == user_id and count > 0)
-            if reactor_reactions_given >= 50:
+            add_achievement(chat_id, author_id, "🌟 Social Master")
+            await safe_notify(context, chat_id, f"🌟 {user_tag(author_id)} unlocked badge: <b>Social Master</b> — 100+ weekly reactions! 🎉")            # Award Love Giver achievement to the reactor
+            if reactions_given[chat_id].get(user_id, 0) >= 50:
                 await grant_ach(context, chat_id, user_id, Ach.LoveGiver, "❤️ <b>Love Giver</b> — spread 50+ reactions!")
 
 # ========= MESSAGE HANDLER (UPDATED) =========
@@ -1411,19 +4256,28 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat.type not in ("group", "supergroup"):
         return
 
-    known_chats.add(chat.id)
+    if chat.id not in known_chats:
+        known_chats.add(chat.id)
+        touch_meta()
 
-    # Store message author for reaction tracking
-    if msg.message_id:
-        message_authors[chat.id][msg.message_id] = user.id
+    name_cache.note(chat.id, user)
+
+    # Store message author for reaction tracking (service messages can't earn reactions)
+    authored_id = msg.message_id if msg.message_id and not msg.new_chat_members and not msg.left_chat_member else 0
+    if authored_id:
+        message_authors[chat.id].add(authored_id, user.id, now_utc())
 
     if msg.new_chat_members:
         for m in msg.new_chat_members:
             if m.is_bot:
                 continue
+            name_cache.note(chat.id, m)
             deadline = now_utc() + NEW_MEMBER_POST_WINDOW
             new_member_deadline[chat.id][m.id] = deadline
+            deadlines.schedule(WARN_NEW_MEMBER, chat.id, m.id, deadline - NEW_MEMBER_WARN_BEFORE)
             user_join_dates[chat.id][m.id] = now_utc()  # Track join date
+            touch(chat.id, m.id)
+            record(Ev.Join, chat.id, m.id)
 
             name = m.first_name or m.username or "User"
             mention_html = f'<a href="tg://user?id={m.id}">{escape_html(name)}</a>'
@@ -1436,20 +4290,20 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     uid = user.id
-    last_activity_utc[chat.id][uid] = now_utc()
-    if uid in new_member_deadline[chat.id]:
-        new_member_deadline[chat.id].pop(uid, None)
-        new_member_warned[chat.id].discard(uid)
-    warned_48h[chat.id].discard(uid)
+    note_activity(chat.id, uid, now_utc())
+    record(Ev.Activity, chat.id, uid, authored_id)
 
     add = content_delta(msg)
     if add > 0:
         total_content_count[chat.id][uid] += add
         daily_content_count[chat.id][uid] += add
         weekly_content_count[chat.id][uid] += add
+        count_rolling_post(chat.id, uid, add, now_utc())
         
         update_streak(chat.id, uid)
         content_type = get_content_type(msg)
+        content_type_count[chat.id][uid][content_type] += 1
+        record(Ev.Post, chat.id, uid, add, text=content_type)
         
         coins_earned = award_coins(chat.id, uid, COIN_DAILY_POST, "Daily post")
         
@@ -1461,6 +4315,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         xp_multiplier = get_multiplier(chat.id, uid, "xp")
         xp_gained = int(add * xp_multiplier)
         xp_levels[chat.id][uid] += xp_gained
+        record(Ev.Xp, chat.id, uid, xp_gained)
         after_xp = xp_levels[chat.id][uid]
         before_lvl = calc_level(before_xp)
         after_lvl = calc_level(after_xp)
@@ -1470,8 +4325,9 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await safe_notify(
                 context,
                 chat.id,
-                f"🎉 {(await mention(context.application, chat.id, uid))} leveled up to <b>Level {after_lvl}</b>! "
-                f"Earned {level_coins} coins! 💰"
+                f"🎉 {user_tag(uid)} leveled up to <b>Level {after_lvl}</b>! "
+                f"Earned {level_coins} coins! 💰",
+                key=f"level:{chat.id}:{uid}:{after_lvl}"
             )
 
         # Update weekly challenge progress
@@ -1500,28 +4356,84 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Check if challenge completed
             new_progress = weekly_challenge_progress[chat.id][uid][challenge_id]
-            if new_progress >= challenge["target"] and challenge_id not in weekly_challenge_completed[chat.id][uid]:
+            completed = new_progress >= challenge["target"]
+            if new_progress != progress or completed:
+                record(Ev.Challenge, chat.id, uid, new_progress, int(completed), text=challenge_id)
+            if completed:
                 weekly_challenge_completed[chat.id][uid].add(challenge_id)
                 challenge_coins = award_coins(chat.id, uid, challenge["reward"], f"Challenge: {challenge['name']}")
                 await safe_notify(
                     context,
                     chat.id,
-                    f"🎯 {(await mention(context.application, chat.id, uid))} completed challenge: "
-                    f"<b>{challenge['name']}</b>! Earned {challenge_coins} coins! 💰"
+                    f"🎯 {user_tag(uid)} completed challenge: "
+                    f"<b>{challenge['name']}</b>! Earned {challenge_coins} coins! 💰",
+                    key=f"challenge:{chat.id}:{uid}:{challenge_id}:{period_epochs['weekly']}"
                 )
 
         await check_achievements(context, chat.id, uid, content_type)
 
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the admin roster and name cache current as members are promoted, demoted or leave"""
+    change = update.chat_member or update.my_chat_member
+    member = change.new_chat_member
+    name_cache.note(change.chat.id, member.user)
+    admin_roster.apply(change.chat.id, member.user.id, member.status)
+
 # ========= MAIN APPLICATION =========
+async def on_stop(application: Application):
+    # The bot can still send here; post_shutdown runs after its client is closed
+    await announcer.flush_pending(timeout=5)
+    await outbound.drain(timeout=5)
+    print(f"Announcements: {announcer.summary()}")
+    print(f"Outbox: {await asyncio.get_running_loop().run_in_executor(None, outbox.summary)}")
+    print(f"Outbound: {outbound.summary()}")
+
+async def on_shutdown(application: Application):
+    write_behind.flush_sync()
+    print(f"Persistence: {write_behind.summary()}")
+    print(f"Message author index:\n{message_index_report()}")
+    print(f"Name cache: {name_cache.summary()}")
+    print(f"Admin roster: {admin_roster.summary()}")
+    print(f"Deadlines: {deadlines.summary()}")
+    print(f"Job fan-out: {fan_out.summary()}")
+    if SNAPSHOT_PATH:
+        try:
+            write_snapshot_sync(SNAPSHOT_PATH)
+        except Exception as e:
+            print(f"Shutdown snapshot failed: {e}")
+    store.close()
+    outbox.close()
+
 def main():
     """Run the bot."""
-    global current_weekly_challenges
+    global current_weekly_challenges, store, outbox
+    
+    # Restore persisted state: snapshot first, then anything the store wrote since
+    snapshot_at = open_snapshot(SNAPSHOT_PATH)
+    store = open_store()
+    store.load(since=snapshot_at)
+    print(f"Loaded state from {store.name} store: {len(known_chats)} chats")
+    outbox = Outbox(OUTBOX_PATH)
+    print(f"Outbox: {outbox.summary()}")
     
     # Initialize weekly challenges
-    current_weekly_challenges = select_weekly_challenges()
+    if not current_weekly_challenges:
+        current_weekly_challenges = select_weekly_challenges()
+        touch_meta()
+        record(Ev.Challenges, 0, text=",".join(sorted(current_weekly_challenges)))
     
     # Create application
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(KeyedUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    # Hydrate an update's chat from the snapshot before any handler touches it
+    application.add_handler(TypeHandler(Update, hydrate_update), group=-1)
     
     # Register command handlers
     application.add_handler(CommandHandler("help", cmd_help))
@@ -1533,6 +4445,7 @@ def main():
     application.add_handler(CommandHandler("badges", cmd_badges))
     application.add_handler(CommandHandler("leaderboard", cmd_leaderboard))
     application.add_handler(CommandHandler("reactions", cmd_reactions))
+    application.add_handler(CommandHandler("loved", cmd_loved))
     application.add_handler(CommandHandler("ranking", cmd_ranking))
     application.add_handler(CommandHandler("level", cmd_level))
     application.add_handler(CommandHandler("streak", cmd_streak))
@@ -1546,25 +4459,44 @@ def main():
     # Register message handlers
     application.add_handler(MessageHandler(filters.ALL, on_message))
     application.add_handler(MessageReactionHandler(on_message_reaction))
+    application.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.ANY_CHAT_MEMBER))
+    
+    # Count each update towards the next write-behind flush
+    application.add_handler(TypeHandler(Update, persist_update), group=1)
     
     # Register job queue
     job_queue = application.job_queue
     
     # Schedule jobs
-    job_queue.run_repeating(job_new_member_enforcer, interval=CHECK_INTERVAL, first=10)
-    job_queue.run_repeating(job_inactivity, interval=CHECK_INTERVAL, first=30)
+    if _snapshot_pending:
+        job_queue.run_once(job_hydrate_snapshot, when=0)
+    job_queue.run_repeating(job_deadlines, interval=DEADLINE_TICK, first=10)
     job_queue.run_repeating(job_streak_checker, interval=STREAK_CHECK_INTERVAL, first=60)
+    job_queue.run_repeating(job_flush_state, interval=PERSIST_FLUSH_INTERVAL, first=PERSIST_FLUSH_INTERVAL)
+    job_queue.run_repeating(job_outbox, interval=OUTBOX_RETRY_INTERVAL, first=5)  # First run resumes undelivered announcements
+    if SNAPSHOT_PATH:
+        job_queue.run_repeating(job_snapshot, interval=SNAPSHOT_INTERVAL, first=SNAPSHOT_INTERVAL)
     
     # Daily job at midnight UTC
     job_queue.run_daily(job_daily_top, time=time(0, 0, tzinfo=UTC))
     
-    # Weekly job using run_repeating with 7-day interval (since run_weekly doesn't exist)
-    job_queue.run_repeating(job_weekly_reset, interval=timedelta(days=7), first=timedelta(seconds=3600))  # Start after 1 hour
+    # Weekly job on the wall-clock boundary; re-arms itself after each run
+    schedule_weekly_reset(job_queue)
     
     print("Bot started! Press Ctrl+C to stop.")
     
     # Run the bot
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+def rebuild_main():
+    """Offline: rebuild state from the full event history using the current point values"""
+    points = {"photo": PTS_PHOTO, "video": PTS_VIDEO, "document": PTS_DOC, "link": PTS_LINK, "text": 1}
+    rebuild_from_history(EVENT_LOG_DIR, points)
+    write_snapshot_sync(SNAPSHOT_PATH)
+    print(f"Rebuilt state for {len(known_chats)} chats into {SNAPSHOT_PATH}")
+
 if __name__ == "__main__":
-    main()
+    if "--rebuild-from-events" in sys.argv:
+        rebuild_main()
+    else:
+        main()
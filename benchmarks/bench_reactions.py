@@ -0,0 +1,61 @@
+"""Per-reaction cost as reaction history grows.
+
+Compares the maintained reactions_given counter (used for the Love Giver
+check) against the old full scan over every reacted post in the chat.
+
+    python benchmarks/bench_reactions.py
+"""
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import UltimateTelegrambot as bot
+
+CHAT_ID = -100
+REACTORS = 500
+SAMPLES = 2000
+
+
+def fill_history(messages: int):
+    """Reset state and react to `messages` posts, each from a few reactors"""
+    bot.post_reactions.clear()
+    bot.reactions_given.clear()
+    bot.weekly_most_loved.clear()
+    bot.MESSAGE_AUTHOR_HORIZON = messages + SAMPLES
+    for message_id in range(1, messages + 1):
+        for reactor_id in range(message_id % 7 + 1):
+            bot.apply_reaction(CHAT_ID, message_id, 1, (message_id + reactor_id) % REACTORS + 2, 1)
+
+
+def time_per_reaction(check) -> float:
+    start_id = len(bot.post_reactions[CHAT_ID]) + 1
+    start = perf_counter()
+    for i in range(SAMPLES):
+        reactor_id = i % REACTORS + 2
+        bot.apply_reaction(CHAT_ID, start_id + i, 1, reactor_id, 1)
+        check(reactor_id)
+    return (perf_counter() - start) / SAMPLES * 1e6
+
+
+def counter_check(reactor_id: int) -> bool:
+    return bot.reactions_given[CHAT_ID].get(reactor_id, 0) >= 50
+
+
+def scan_check(reactor_id: int) -> bool:
+    return sum(1 for post in bot.post_reactions[CHAT_ID].values() if reactor_id in post.reactors) >= 50
+
+
+def main():
+    print(f"{'history':>10} {'counter (us)':>14} {'full scan (us)':>16}")
+    for messages in (1_000, 10_000, 100_000):
+        fill_history(messages)
+        counter = time_per_reaction(counter_check)
+        fill_history(messages)
+        scan = time_per_reaction(scan_check)
+        print(f"{messages:>10} {counter:>14.2f} {scan:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import sys
+from collections import defaultdict
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import UltimateTelegrambot as bot
+
+
+def clear_state():
+    """Empty every in-memory table, as on a fresh start"""
+    for value in vars(bot).values():
+        if isinstance(value, defaultdict):
+            value.clear()
+    for table in (bot.known_chats, bot.chat_epochs, bot.period_boundaries, bot.rolling_ranks,
+                  bot.snapshot_meta, bot._snapshot_pending, bot.write_behind.dirty):
+        table.clear()
+    bot.period_epochs.update(daily=0, weekly=0)
+    bot.close_snapshot()
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    clear_state()
+    yield
+    clear_state()
+    bot.event_log = None
+
+
+@pytest.fixture
+def restart():
+    """Call to drop the in-memory state mid-test, as a process restart would"""
+    return clear_state
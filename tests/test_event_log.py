@@ -0,0 +1,101 @@
+import asyncio
+import threading
+
+import pytest
+
+import UltimateTelegrambot as bot
+
+CHAT_ID = -2002
+
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "SNAPSHOT_PATH", str(tmp_path / "state.snap"))
+    return str(tmp_path / "events")
+
+
+def make_changes(first_user: int = 1):
+    for user_id in range(first_user, first_user + 20):
+        bot.award_coins(CHAT_ID, user_id, user_id)
+        bot.record(bot.Ev.Post, CHAT_ID, user_id, 2, text="photo")
+        bot.apply_event(bot.Ev.Post, bot.now_utc().timestamp(), CHAT_ID, user_id, 2, 0, 0, "photo")
+
+
+def state():
+    return dict(bot.user_coins[CHAT_ID]), bot.total_content_count[CHAT_ID].top(50)
+
+
+def reopen(log_dir: str) -> bot.EventLogStore:
+    store = bot.EventLogStore(log_dir)
+    store.load(bot.open_snapshot(bot.SNAPSHOT_PATH))
+    bot.ensure_all_loaded()
+    return store
+
+
+def test_append_sync_replay(log_dir, restart):
+    store = bot.EventLogStore(log_dir)
+    make_changes()
+    store.write([], {})  # Syncs the log
+    expected = state()
+    store.close()
+
+    restart()
+    store = reopen(log_dir)
+    assert state() == expected
+    assert store.log.seq == 40
+    store.close()
+
+
+def test_compact_then_replay(log_dir, restart):
+    store = bot.EventLogStore(log_dir)
+    make_changes()
+    asyncio.run(bot.compact_event_log(store))
+    assert [n for n, _ in bot.list_segments(log_dir)] == [2]
+    make_changes(first_user=100)
+    store.close()
+    expected = state()
+
+    restart()
+    store = reopen(log_dir)
+    assert state() == expected
+    store.close()
+
+    restart()
+    bot.rebuild_from_history(log_dir)
+    assert state() == expected
+
+
+def test_replay_skips_duplicate_records(log_dir, restart):
+    store = bot.EventLogStore(log_dir)
+    make_changes()
+    store.close()
+    expected = state()
+    (_, path), = bot.list_segments(log_dir)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "ab") as f:
+        f.write(data)  # Every record written twice
+
+    restart()
+    store = reopen(log_dir)
+    assert state() == expected
+    store.close()
+
+
+def test_sync_during_appends_writes_each_record_once(log_dir):
+    log = bot.EventLog(log_dir)
+    done = threading.Event()
+
+    def syncer():
+        while not done.is_set():
+            log.sync()
+
+    thread = threading.Thread(target=syncer)
+    thread.start()
+    for user_id in range(50000):
+        log.append(bot.Ev.Coins, CHAT_ID, user_id, 1, 0, 0, "")
+    done.set()
+    thread.join()
+    log.close()
+    seqs = [record[1] for _, path in bot.list_segments(log_dir) for record in bot.read_segment(path)]
+    assert seqs == list(range(1, 50001))
@@ -0,0 +1,62 @@
+import random
+
+import UltimateTelegrambot as bot
+
+
+def reference(scores: dict) -> list:
+    """(user_id, score) highest first, ties by user id"""
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def test_rank_index_matches_sorted_keys():
+    rng = random.Random(1)
+    index, keys = bot.RankIndex(), set()
+    for _ in range(3000):
+        key = rng.randrange(5000)
+        if key in keys:
+            index.remove(key)
+            keys.discard(key)
+        else:
+            index.insert(key)
+            keys.add(key)
+    ordered = sorted(keys)
+    assert len(index) == len(ordered)
+    assert index.first(50) == ordered[:50]
+    for position, key in enumerate(ordered, 1):
+        assert index.rank(key) == position
+    assert index.rank(5001) is None
+
+
+def test_rank_index_build_then_update():
+    index = bot.RankIndex()
+    index.build(list(range(0, 200, 2)))
+    index.insert(7)
+    index.remove(0)
+    assert index.first(4) == [2, 4, 6, 7]
+    assert index.rank(8) == 5
+
+
+def test_ranked_scores_follow_every_write_path():
+    rng = random.Random(2)
+    scores, expected = bot.RankedScores(), {}
+    scores.update({user_id: rng.randrange(1, 50) for user_id in range(1, 40)})
+    expected.update(scores)
+    assert scores.top(5) == reference(expected)[:5]  # Builds the index
+    for _ in range(2000):
+        user_id = rng.randrange(1, 80)
+        if rng.random() < 0.2:
+            scores.pop(user_id, None)
+            expected.pop(user_id, None)
+        else:
+            delta = rng.randrange(1, 10)
+            scores[user_id] += delta
+            expected[user_id] = expected.get(user_id, 0) + delta
+    ranked = reference(expected)
+    assert scores.top(10) == ranked[:10]
+    assert scores.total == sum(expected.values())
+    assert len(scores) == len(expected)
+    for position, (user_id, _) in enumerate(ranked, 1):
+        assert scores.rank(user_id) == position
+    assert scores[10 ** 9] == 0 and 10 ** 9 not in scores
+    scores.clear()
+    assert scores.top(3) == [] and scores.total == 0
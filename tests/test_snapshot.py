@@ -0,0 +1,78 @@
+from datetime import timedelta
+
+import UltimateTelegrambot as bot
+
+CHAT_ID = -1001
+
+
+def fill_chat(now):
+    bot.known_chats.add(CHAT_ID)
+    for user_id in range(1, 30):
+        bot.total_content_count[CHAT_ID][user_id] = user_id * 3
+        bot.weekly_content_count[CHAT_ID][user_id] = user_id
+        bot.xp_levels[CHAT_ID][user_id] = user_id * 10
+        bot.last_activity_utc[CHAT_ID][user_id] = now - timedelta(hours=user_id)
+        bot.count_rolling_post(CHAT_ID, user_id, user_id % 4 + 1, now - timedelta(hours=user_id))
+    bot.user_titles[CHAT_ID][3] = "Veteran"
+    bot.achievements[CHAT_ID][5].update({"first_post", "streak_7"})
+    bot.warned_48h[CHAT_ID].add(7)
+    bot.referral_relationships[CHAT_ID][9] = 2
+    bot.referral_milestones_claimed[CHAT_ID].add((2, 9))
+    for message_id in range(1, 120):
+        bot.message_authors[CHAT_ID].add(message_id, message_id % 5 + 1, now)
+    for message_id in range(1, 40):
+        for reactor_id in range(message_id % 4):
+            bot.apply_reaction(CHAT_ID, message_id, message_id % 5 + 1, 100 + reactor_id, 1)
+
+
+def chat_state(now):
+    bucket = bot.bucket_of(now)
+    return {
+        "total": bot.total_content_count[CHAT_ID].top(100),
+        "weekly": dict(bot.weekly_content_count[CHAT_ID]),
+        "xp": bot.xp_levels[CHAT_ID].top(5),
+        "activity": dict(bot.last_activity_utc[CHAT_ID]),
+        "rolling": {uid: c.counts(bucket) for uid, c in bot.rolling_posts[CHAT_ID].items()},
+        "titles": dict(bot.user_titles[CHAT_ID]),
+        "achievements": {uid: set(a) for uid, a in bot.achievements[CHAT_ID].items() if a},
+        "warned": set(bot.warned_48h[CHAT_ID]),
+        "milestones": set(bot.referral_milestones_claimed[CHAT_ID]),
+        "authors": [bot.message_authors[CHAT_ID].get(m, now) for m in range(1, 120)],
+        "reactions": {m: (p.total, dict(p.reactors)) for m, p in bot.post_reactions[CHAT_ID].items()},
+        "loved": bot.weekly_most_loved[CHAT_ID].top(),
+    }
+
+
+def test_snapshot_round_trip(tmp_path, restart):
+    now = bot.now_utc()
+    fill_chat(now)
+    expected = chat_state(now)
+    path = str(tmp_path / "state.snap")
+    bot.write_snapshot_sync(path)
+
+    restart()
+    assert bot.open_snapshot(path) is not None
+    assert CHAT_ID in bot._snapshot_pending
+    bot.ensure_all_loaded()
+    assert not bot._snapshot_pending
+    assert chat_state(now) == expected
+
+
+def test_snapshot_defers_changes_until_hydrated(tmp_path, restart):
+    now = bot.now_utc()
+    fill_chat(now)
+    path = str(tmp_path / "state.snap")
+    bot.write_snapshot_sync(path)
+
+    restart()
+    bot.open_snapshot(path)
+    assert bot.defer_until_hydrated(CHAT_ID, lambda: bot.total_content_count[CHAT_ID].__setitem__(1, 1000))
+    assert not bot.total_content_count.get(CHAT_ID)
+    bot.ensure_chat_loaded(CHAT_ID)
+    assert bot.total_content_count[CHAT_ID].top(1) == [(1, 1000)]
+
+
+def test_unreadable_snapshot_is_ignored(tmp_path):
+    path = tmp_path / "state.snap"
+    path.write_bytes(b"not a snapshot")
+    assert bot.open_snapshot(str(path)) is None